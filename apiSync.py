@@ -2,27 +2,249 @@
 # Gives options for complete or incremental updates.
 # Requires Cin7Core_API.json and Xero_API.json files. The config.json file was not included as it contains the API credentials and database connection string.
 # The json config files allow for non-programmers to easily modify which endpoints and fields are synced.
-# API calls and database writing are executed asynchronously for speed.
+# API calls and database writing are executed asynchronously for speed. API calls share a pooled async HTTP client (keep-alive, per-host connection limits, HTTP/2 where available).
 # The database writing function automatically alters the table columns of string fields if the data length exceeds the current column length. This avoids the need for a technical user to identify and alter the columns manually.
-# The SQL database tables include primary and foreign key constraints. The config files are ordered in a way to ensure that parent tables are updated before child tables.
+# The SQL database tables include primary and foreign key constraints. Config entries are scheduled from the database's foreign keys (plus optional "depends_on" lists) so parent tables are committed before child tables start, with constraints left enabled.
 # Staging tables are used to allow for upserts.
+# Run with --coordinator and any number of --worker processes (on any machine) to split a sync into leased work units in the sync_queue table.
+# Endpoints marked "fingerprint": true are hashed page by page (Xero also probes with If-Modified-Since); when nothing changed since the last run the flatten, write and merge are skipped.
+# Raw pages and records can be kept in a compressed content-addressed archive (config.json "Archive"); run with --rebuild to reload the tables from the archive without any API calls.
+# Run with --service (schedules from config.json "Service") or --schedule CRON TARGET for a headless daemon with cron-like per-endpoint schedules on one persistent event loop.
 
-import requests
+import httpx
 import pyodbc
+import argparse
 import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import gzip
+import hashlib
+import http.server
+import importlib.util
 import json
 import math
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sqlite3
+import sys
+import tempfile
+import threading
+import queue
 import time
+import uuid
+import random
+import re
 import datetime
 import dateutil
+import email.utils
 
-class Cin7CoreApi:
+class Metrics:
+    def __init__(self):
+        with open("config.json", "r") as f:
+            config = json.load(f)
+
+        self.prometheus_file = config.get("Metrics", {}).get("prometheus_file", None)
+        self.prometheus_port = config.get("Metrics", {}).get("prometheus_port", None)
+        self.prometheus_host = config.get("Metrics", {}).get("prometheus_host", "127.0.0.1")
+        self.lock = threading.Lock()
+        self.text = ""
+        self.server = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.run_id = str(uuid.uuid4())
+            self.started = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+            self.values = collections.defaultdict(float)
+
+    def add(self, metric, value=1, api="", endpoint="", table=""):
+        with self.lock:
+            self.values[(api, endpoint, table, metric)] += value
+
+    @contextlib.contextmanager
+    def timer(self, metric, api="", endpoint="", table=""):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(metric, time.perf_counter() - start, api, endpoint, table)
+
+    def rows(self):
+        with self.lock:
+            return [(self.run_id, self.started, api, endpoint, table, metric, value) for (api, endpoint, table, metric), value in self.values.items()]
+
+    def prometheus(self):
+        lines = []
+        for metric in sorted({key[3] for key in self.values}):
+            lines.append(f"# TYPE sync_{metric} gauge")
+            for (api, endpoint, table, name), value in sorted(self.values.items()):
+                if name == metric:
+                    lines.append(f'sync_{metric}{{api="{api}",endpoint="{endpoint}",table="{table}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def export(self, db):
+        self.add("run_seconds", (datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None) - self.started).total_seconds())
+        rows = self.rows()
+        if rows:
+            db.executemany("INSERT INTO sync_runs (RunID, Started, Api, Endpoint, TableName, Metric, Value) VALUES (?, ?, ?, ?, ?, ?, ?);", rows)
+
+        with self.lock:
+            self.text = self.prometheus()
+
+        if self.prometheus_file:
+            with open(self.prometheus_file + ".tmp", "w") as f:
+                f.write(self.text)
+            os.replace(self.prometheus_file + ".tmp", self.prometheus_file)
+
+        if self.prometheus_port and self.server is None:
+            metrics = self
+
+            class Handler(http.server.BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = metrics.text.encode()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            self.server = http.server.ThreadingHTTPServer((self.prometheus_host, self.prometheus_port), Handler)
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+class HttpClient:
     def __init__(self):
         with open("config.json", "r") as f:
             config = json.load(f)
 
+        http = config.get("Http", {})
+        self.max_connections = http.get("max_connections", 20)
+        self.max_keepalive = http.get("max_keepalive", 20)
+        self.keepalive_expiry = http.get("keepalive_expiry", 60)
+        self.timeout = http.get("timeout", 60)
+        self.hosts = http.get("hosts", {})
+        self.http2 = http.get("http2", True) and importlib.util.find_spec("h2") is not None
+
+        self.clients = {}
+        self.loop = None
+
+    def client(self, url):
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            self.clients = {}
+            self.loop = loop
+
+        host = httpx.URL(url).host
+        if host not in self.clients:
+            limits = self.hosts.get(host, {})
+            self.clients[host] = httpx.AsyncClient(
+                http2=self.http2,
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=limits.get("max_connections", self.max_connections),
+                    max_keepalive_connections=limits.get("max_keepalive", self.max_keepalive),
+                    keepalive_expiry=self.keepalive_expiry
+                )
+            )
+        return self.clients[host]
+
+    async def get(self, url, **kwargs):
+        return await self.client(url).get(url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.client(url).post(url, **kwargs)
+
+    async def close(self):
+        for client in self.clients.values():
+            await client.aclose()
+        self.clients = {}
+
+class RateLimiter:
+    def __init__(self, calls_per_minute=60, max_concurrency=5, max_backoff=60):
+        self.rate = calls_per_minute / 60
+        self.capacity = max(1, max_concurrency)
+        self.max_concurrency = max_concurrency
+        self.max_backoff = max_backoff
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.loop = None
+
+    def bind(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            self.lock = asyncio.Lock()
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+            self.loop = loop
+
+    async def __aenter__(self):
+        self.bind()
+        await self.semaphore.acquire()
+        try:
+            async with self.lock:
+                while True:
+                    now = time.monotonic()
+                    if now < self.paused_until:
+                        await asyncio.sleep(self.paused_until - now)
+                        continue
+
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return self
+
+                    await asyncio.sleep((1 - self.tokens) / self.rate)
+        except BaseException:
+            self.semaphore.release()
+            raise
+
+    async def __aexit__(self, *args):
+        self.semaphore.release()
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def update(self, response):
+        retry_after = response.headers.get("Retry-After")
+        if retry_after:
+            try:
+                self.pause(float(retry_after))
+            except ValueError:
+                try:
+                    retry_date = email.utils.parsedate_to_datetime(retry_after)
+                    self.pause((retry_date - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+                except (TypeError, ValueError):
+                    self.pause(self.max_backoff)
+            return
+
+        if response.headers.get("X-DayLimit-Remaining") == "0":
+            self.pause(3600)
+        elif response.headers.get("X-MinLimit-Remaining") == "0":
+            self.pause(60)
+        elif response.status_code in (429, 503):
+            self.pause(self.backoff(0))
+
+    def backoff(self, attempt):
+        return random.uniform(0.5, 1) * min(self.max_backoff, 2 ** attempt)
+
+class Cin7CoreApi:
+    def __init__(self, http: HttpClient=None, metrics: Metrics=None):
+        with open("config.json", "r") as f:
+            config = json.load(f)
+
+        self.http = http or HttpClient()
+        self.metrics = metrics or Metrics()
         self.url = config["Cin7CoreApi"]["url"]
         self.headers = config["Cin7CoreApi"]["headers"]
+        self.limiter = RateLimiter(config["Cin7CoreApi"].get("calls_per_minute", 60), config["Cin7CoreApi"].get("max_concurrency", 5))
         
         with open("Cin7Core_API.json", "r") as f:
             self.config = json.load(f)
@@ -37,7 +259,7 @@ class Cin7CoreApi:
                 mod_params[k] = v
         return mod_params
 
-    def get_data(self, data_type, endpoint, page=None, params=None, key=None, id=None, delay=0):   
+    async def get_data(self, data_type, endpoint, page=None, params=None, key=None, id=None):
         if data_type == "page":
             mod_params={"Page": page, "Limit": 1}
         elif data_type == "table":
@@ -48,51 +270,78 @@ class Cin7CoreApi:
         if params:
             mod_params.update(params)
 
+        attempt = 0
         while True:
-            time.sleep(delay)
             try:
-                response = requests.get(self.url + endpoint, headers=self.headers, params=mod_params)
+                async with self.limiter:
+                    response = await self.http.get(self.url + endpoint, headers=self.headers, params=mod_params)
+                self.metrics.add("api_calls", api="cin7core", endpoint=endpoint)
+                self.metrics.add("bytes_downloaded", len(response.content), api="cin7core", endpoint=endpoint)
+                self.limiter.update(response)
                 response.raise_for_status()
 
-                if response.headers.get("Content-Type") != "application/json; charset=utf-8":
-                    continue
+                if not response.headers.get("Content-Type", "").startswith("application/json"):
+                    raise ValueError(f"Unexpected Content-Type: {response.headers.get('Content-Type')}")
 
                 if data_type == "page":
                     return math.ceil(response.json().get("Total", 0) / 1000)
                 else:
                     return response.json()
 
-            except requests.exceptions.RequestException:
-                delay = min(delay + 1, 10)
+            except (httpx.HTTPError, ValueError):
+                delay = self.limiter.backoff(attempt)
+                self.metrics.add("retries", api="cin7core", endpoint=endpoint)
+                self.metrics.add("backoff_seconds", delay, api="cin7core", endpoint=endpoint)
+                await asyncio.sleep(delay)
+                attempt += 1
                 continue
 
     @staticmethod
+    @functools.lru_cache(maxsize=65536)
     def format_date(date):
         if not date:
             return None
         try:
+            if len(date) >= 10 and date[4] == "-" and date[7] == "-":
+                return datetime.date.fromisoformat(date[:10])
             return datetime.datetime.fromisoformat(date).date()
         except (ValueError, TypeError):
             try:
                 return dateutil.parser.parse(date, dayfirst=True).date()
-            except (ValueError, TypeError):
+            except (ValueError, TypeError, OverflowError):
                 return None
 
-    def field_list(self, item, fields, date_fields, parent=None, parent_id=None, item2=None, fields2=None, item3=None, fields3=None):
-        result = []
-        parent_count = 0
-        for field in fields:
-            if parent and field == parent and parent_count == 0:
-                value = parent_id
-                parent_count = 1
-            elif item2 and field in fields2:
-                value = item2.get(field)
-            elif item3 and field in fields3:
-                value = item3.get(field)
+    @staticmethod
+    def compile(fields, date_fields=None, parent=None, fields2=None, fields3=None):
+        date_fields = set(date_fields or [])
+        fields2 = set(fields2 or [])
+        fields3 = set(fields3 or [])
+        parent_idx = fields.index(parent) if parent in fields else None
+
+        plan = []
+        for idx, field in enumerate(fields):
+            if idx == parent_idx:
+                source = 0
+            elif field in fields2:
+                source = 2
+            elif field in fields3:
+                source = 3
             else:
-                value = item.get(field)
-            if field in date_fields:
-                value = self.format_date(value)
+                source = 1
+            plan.append((source, field, field in date_fields))
+
+        return tuple(plan)
+
+    @staticmethod
+    def field_list(plan, item, parent_id=None, item2=None, item3=None):
+        sources = (None, item, item2 or item, item3 or item)
+        format_date = Cin7CoreApi.format_date
+
+        result = []
+        for source, field, date in plan:
+            value = sources[source].get(field) if source else parent_id
+            if date:
+                value = format_date(value)
             result.append(value)
 
         if all(v is None for v in result):
@@ -100,51 +349,96 @@ class Cin7CoreApi:
         
         return tuple(result)
 
+    def rows(self, plan, items, parent_id=None):
+        field_list = self.field_list
+        with self.metrics.timer("flatten_seconds", api="cin7core"):
+            return [row for row in (field_list(plan, item, parent_id) for item in items) if row is not None]
+
     def mod_fields(self, fields, mod_fields):
         return [fields[0]] + [mod_fields.get(field, field) for field in fields[1:]]
 
 class XeroApi:
-    def __init__(self):
+    def __init__(self, http: HttpClient=None, metrics: Metrics=None):
         with open("config.json", 'r') as f:
             config = json.load(f)
 
+        self.http = http or HttpClient()
+        self.metrics = metrics or Metrics()
         self.clientId = config["Xero"]["clientId"]
         self.clientSecret = config["Xero"]["clientSecret"]
         self.tokenUrl = config["Xero"]["tokenUrl"]
         self.connUrl = config["Xero"]["connUrl"]
         self.url = config["Xero"]["url"]
+        self.calls_per_minute = config["Xero"].get("calls_per_minute", 60)
+        self.max_concurrency = config["Xero"].get("max_concurrency", 5)
+        self.limiters = {}
+        self.allowed_tenants = config["Xero"].get("tenants", None)
+        self.refresh_margin = config["Xero"].get("refresh_margin", 300)
+        self.token = None
+        self.tenants = None
+        self.expires = 0
+        self.loop = None
 
         with open("Xero_API.json", "r") as f:
             self.config = json.load(f)
 
-    def access(self, delay=0):
-        while True:
-            time.sleep(delay)
-            try:
-                response = requests.post(self.tokenUrl,data={"grant_type": "client_credentials"}, auth=(self.clientId, self.clientSecret))
-                response.raise_for_status()
-                token = response.json()["access_token"]
-                headers = {"Authorization": f"Bearer {token}", "Accept": "application/json"}
-                delay = 0
-                break
-            except requests.exceptions.RequestException:
-                delay = min(delay + 5, 10)
-                continue
+    async def access(self, delay=0, stale=None):
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            self.lock = asyncio.Lock()
+            self.loop = loop
 
-        while True:
-            time.sleep(delay)
-            try:
-                response = requests.get(self.connUrl, headers=headers)
-                response.raise_for_status()
-                tenant = response.json()[0]["tenantId"]
-                return token, tenant
-            except requests.exceptions.RequestException:
-                delay = min(delay + 5, 10)
-                continue
+        async with self.lock:
+            if self.token and self.token != stale and time.monotonic() < self.expires - self.refresh_margin:
+                return self.token, self.tenants
+
+            while True:
+                await asyncio.sleep(delay)
+                try:
+                    response = await self.http.post(self.tokenUrl, data={"grant_type": "client_credentials"}, auth=(self.clientId, self.clientSecret))
+                    response.raise_for_status()
+                    token = response.json()["access_token"]
+                    expires = time.monotonic() + response.json().get("expires_in", 1800)
+                    headers = {"Authorization": f"Bearer {token}", "Accept": "application/json"}
+                    delay = 0
+                    break
+                except (httpx.HTTPError, ValueError, KeyError):
+                    delay = min(delay + 5, 10)
+                    continue
+
+            tenants = None
+            while tenants is None:
+                await asyncio.sleep(delay)
+                try:
+                    response = await self.http.get(self.connUrl, headers=headers)
+                    response.raise_for_status()
+                    connections = [connection["tenantId"] for connection in response.json() if connection.get("tenantType", "ORGANISATION") == "ORGANISATION"]
+                except (httpx.HTTPError, ValueError, KeyError):
+                    delay = min(delay + 5, 10)
+                    continue
+                tenants = [tenant for tenant in connections if tenant in self.allowed_tenants] if self.allowed_tenants else connections
+
+            if not tenants:
+                if self.allowed_tenants:
+                    raise RuntimeError(f"None of the configured Xero tenants {self.allowed_tenants} is connected (connected: {connections})")
+                raise RuntimeError("No Xero organisation is connected to this app")
+
+            self.token = token
+            self.tenants = tenants
+            self.expires = expires
+            return self.token, self.tenants
 
-    def get_data(self, data_type, token, tenant, endpoint, start_date=None, page=None, delay=0):
+    def limiter(self, tenant):
+        if tenant not in self.limiters:
+            self.limiters[tenant] = RateLimiter(self.calls_per_minute, self.max_concurrency)
+        return self.limiters[tenant]
+
+    async def get_data(self, data_type, tenant, endpoint, start_date=None, page=None):
+        token, _ = await self.access()
         headers = {"Authorization": f"Bearer {token}", "Xero-Tenant-Id": tenant, "Accept": "application/json"}
-        
+        limiter = self.limiter(tenant)
+        reauthorised = False
+
         if start_date:
             headers.update({"if-Modified-Since": start_date})
         
@@ -155,177 +449,1089 @@ class XeroApi:
         else:
             params = None
 
+        attempt = 0
         while True:
-            time.sleep(delay)
             try:
-                response = requests.get(self.url + endpoint, headers=headers, params=params)
+                async with limiter:
+                    response = await self.http.get(self.url + endpoint, headers=headers, params=params)
+                self.metrics.add("api_calls", api="xero", endpoint=endpoint)
+                self.metrics.add("bytes_downloaded", len(response.content), api="xero", endpoint=endpoint)
+                limiter.update(response)
+                if response.status_code == 401 and not reauthorised:
+                    token, _ = await self.access(stale=token)
+                    headers["Authorization"] = f"Bearer {token}"
+                    reauthorised = True
+                    continue
+                if response.status_code == 304:
+                    return 0 if data_type == "page" else []
                 response.raise_for_status()
                 if data_type == "page":
                     return response.json()["pagination"]["pageCount"]
                 else:
                     return response.json().get(endpoint, [])
-            except requests.exceptions.RequestException:
-                delay = min(delay + 5, 10)
+            except (httpx.HTTPError, ValueError, KeyError):
+                delay = limiter.backoff(attempt)
+                self.metrics.add("retries", api="xero", endpoint=endpoint)
+                self.metrics.add("backoff_seconds", delay, api="xero", endpoint=endpoint)
+                await asyncio.sleep(delay)
+                attempt += 1
                 continue
 
     @staticmethod
+    @functools.lru_cache(maxsize=65536)
     def format_date(unixtimestamp):
-        if unixtimestamp:
-            date = datetime.datetime.fromtimestamp(int(unixtimestamp[6:19]) / 1000).strftime('%Y-%m-%d')
-            return date
-        return None
+        if not unixtimestamp:
+            return None
+        match = re.match(r"/Date\((-?\d+)", unixtimestamp)
+        if match:
+            return (datetime.datetime(1970, 1, 1) + datetime.timedelta(milliseconds=int(match.group(1)))).date()
+        try:
+            return datetime.datetime.fromisoformat(unixtimestamp).date()
+        except (ValueError, TypeError):
+            return None
 
-    def field_list(self, item, fields, date_fields, parent=None, parent_id=None):
-        result = []
+    @staticmethod
+    def compile(fields, date_fields=None, parent=None):
+        date_fields = set(date_fields or [])
 
+        plan = []
         for field in fields:
-            if parent is not None and field == parent:
+            path = None if parent is not None and field == parent else tuple(field.split("_"))
+            plan.append((path, field in date_fields))
+
+        return tuple(plan)
+
+    def field_list(self, plan, item, parent_id=None, prefix=()):
+        format_date = self.format_date
+
+        result = []
+        for path, date in plan:
+            if path is None:
                 value = parent_id
-            elif "_" in field:
-                parts = field.split("_")
+            elif len(path) == 1:
+                value = item.get(path[0])
+            else:
                 value = item
-                for part in parts:
+                for part in path:
                     if isinstance(value, dict):
                         value = value.get(part)
                     else:
                         value = None
                         break
 
-            else:
-                value = item.get(field)
-
-            if field in date_fields:
-                value = self.format_date(value)
+            if date:
+                value = format_date(value)
             result.append(value)
 
         if all(v is None for v in result):
             return None
         
-        return tuple(result)
+        return prefix + tuple(result)
+
+    def rows(self, plan, items, parent_id=None, prefix=()):
+        field_list = self.field_list
+        with self.metrics.timer("flatten_seconds", api="xero"):
+            return [row for row in (field_list(plan, item, parent_id, prefix) for item in items) if row is not None]
+
+class ConnectionPool:
+    transient_errors = {40613, 40197, 40501, 40540, 40544, 40549, 10928, 10929, 49918, 49919, 49920, 4060, 4221, 233, 10053, 10054, 10060}
+    transient_states = {"08S01"}
+
+    def __init__(self, db_conn, size=10, health_check=30, retries=5):
+        self.db_conn = db_conn
+        self.size = size
+        self.slots = threading.BoundedSemaphore(size)
+        self.idle = queue.LifoQueue()
+        self.health_check = health_check
+        self.retries = retries
+
+    @classmethod
+    def transient(cls, error):
+        # pyodbc errors carry (SQLSTATE, message); each diagnostic record in the message ends with "(<native error>) (SQL<function>)".
+        args = getattr(error, "args", ())
+        if args and args[0] in cls.transient_states:
+            return True
+        message = str(args[1]) if len(args) > 1 else str(error)
+        return any(int(code) in cls.transient_errors for code in re.findall(r"\((\d+)\) \(SQL\w*\)", message))
+
+    def connect(self):
+        attempt = 0
+        while True:
+            try:
+                return pyodbc.connect(self.db_conn, autocommit=False)
+            except pyodbc.Error as e:
+                if not self.transient(e) or attempt >= self.retries:
+                    raise
+                time.sleep(random.uniform(0.5, 1) * min(30, 2 ** attempt))
+                attempt += 1
+
+    def acquire(self):
+        self.slots.acquire()
+        try:
+            while True:
+                try:
+                    connection, released = self.idle.get_nowait()
+                except queue.Empty:
+                    return self.connect()
+
+                if time.monotonic() - released < self.health_check:
+                    return connection
+                try:
+                    connection.cursor().execute("SELECT 1;").fetchall()
+                    return connection
+                except pyodbc.Error:
+                    self.discard(connection)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, connection, broken=False):
+        try:
+            if broken:
+                self.discard(connection)
+            else:
+                try:
+                    connection.rollback()
+                    self.idle.put((connection, time.monotonic()))
+                except pyodbc.Error:
+                    self.discard(connection)
+        finally:
+            self.slots.release()
+
+    @staticmethod
+    def discard(connection):
+        try:
+            connection.close()
+        except pyodbc.Error:
+            pass
+
+    @contextlib.contextmanager
+    def connection(self):
+        connection = self.acquire()
+        broken = False
+        try:
+            yield connection
+        except pyodbc.Error as e:
+            broken = self.transient(e)
+            raise
+        finally:
+            self.release(connection, broken)
+
+    def run(self, func):
+        attempt = 0
+        while True:
+            try:
+                with self.connection() as connection:
+                    return func(connection)
+            except pyodbc.Error as e:
+                if not self.transient(e) or attempt >= self.retries:
+                    raise
+                time.sleep(random.uniform(0.5, 1) * min(30, 2 ** attempt))
+                attempt += 1
+
+    def close(self):
+        while True:
+            try:
+                connection, _ = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            self.discard(connection)
 
 class Database:
-    def __init__(self):
+    sync_tables = {
+        "sync_watermarks": """
+            CREATE TABLE sync_watermarks (
+                Api VARCHAR(20) NOT NULL,
+                Endpoint VARCHAR(200) NOT NULL,
+                Watermark DATETIME2 NOT NULL,
+                Updated DATETIME2 NOT NULL,
+                PRIMARY KEY (Api, Endpoint)
+            );
+        """,
+        "sync_fingerprints": """
+            CREATE TABLE sync_fingerprints (
+                Api VARCHAR(20) NOT NULL,
+                Endpoint VARCHAR(200) NOT NULL,
+                Fingerprint CHAR(64) NOT NULL,
+                Checked DATETIME2 NOT NULL,
+                PRIMARY KEY (Api, Endpoint)
+            );
+        """,
+        "sync_runs": """
+            CREATE TABLE sync_runs (
+                RunID UNIQUEIDENTIFIER NOT NULL,
+                Started DATETIME2 NOT NULL,
+                Api VARCHAR(20) NOT NULL,
+                Endpoint VARCHAR(200) NOT NULL,
+                TableName VARCHAR(200) NOT NULL,
+                Metric VARCHAR(100) NOT NULL,
+                Value FLOAT NOT NULL
+            );
+        """,
+        "sync_queue": """
+            BEGIN
+                CREATE TABLE sync_queue (
+                    UnitID BIGINT IDENTITY(1,1) PRIMARY KEY,
+                    RunID UNIQUEIDENTIFIER NOT NULL,
+                    Api VARCHAR(20) NOT NULL,
+                    Endpoint VARCHAR(200) NOT NULL,
+                    Stage INT NOT NULL,
+                    Days INT NULL,
+                    Payload NVARCHAR(MAX) NOT NULL,
+                    Status VARCHAR(10) NOT NULL DEFAULT 'pending',
+                    Worker VARCHAR(100) NULL,
+                    LeaseUntil DATETIME2 NULL,
+                    Attempts INT NOT NULL DEFAULT 0,
+                    Watermark DATETIME2 NULL,
+                    Error NVARCHAR(MAX) NULL,
+                    Finished DATETIME2 NULL
+                );
+                CREATE INDEX IX_sync_queue_Status ON sync_queue (Status, RunID, Api, Stage);
+            END
+        """
+    }
+
+    def __init__(self, metrics: Metrics=None):
         with open("config.json", "r") as f:
             config = json.load(f)
 
+        self.metrics = metrics or Metrics()
         self.db_conn = config["Azure"]
+        self.pool = ConnectionPool(self.db_conn, config.get("Pool", {}).get("size", 10), config.get("Pool", {}).get("health_check", 30))
+        self.bcp = shutil.which(config.get("Bulk", {}).get("bcp", "bcp"))
+        self.bcp_extra = config.get("Bulk", {}).get("args", ["-C", "65001"])
+        self.bcp_timeout = config.get("Bulk", {}).get("timeout", 600)
+        self.backup_mode = config.get("Backup", {}).get("mode", "incremental")
+        self.backup_workers = config.get("Backup", {}).get("workers", 4)
+        self.columns = {}
+        self.widths = {}
+        self.tenant_tables = set()
+
+    def bcp_args(self):
+        conn = {}
+        for part in self.db_conn.split(";"):
+            if "=" in part:
+                k, v = part.split("=", 1)
+                conn[k.strip().lower()] = v.strip().strip("{}")
+
+        args = ["-S", conn.get("server", conn.get("address", "")), "-d", conn.get("database", conn.get("initial catalog", ""))]
+        user = conn.get("uid", conn.get("user id"))
+        if not user:
+            return None, None
+
+        args += ["-U", user]
+        if "activedirectory" in conn.get("authentication", "").lower():
+            args.append("-G")
+        return args + self.bcp_extra, conn.get("pwd", conn.get("password", ""))
+
+    def column_order(self, schema, table, cursor=None):
+        if (schema, table) not in self.columns:
+            rows = self.fetch_query("""
+                SELECT COLUMN_NAME, ORDINAL_POSITION
+                FROM INFORMATION_SCHEMA.COLUMNS
+                WHERE TABLE_SCHEMA = ? AND TABLE_NAME = ?
+            """, (schema, table), cursor=cursor)
+            self.columns[(schema, table)] = {row[0].lower(): row[1] for row in rows}
+        return self.columns[(schema, table)]
+
+    def table_columns(self, table):
+        rows = self.fetch_query("""
+            SELECT COLUMN_NAME
+            FROM INFORMATION_SCHEMA.COLUMNS
+            WHERE TABLE_SCHEMA = 'dbo' AND TABLE_NAME = ?
+            ORDER BY ORDINAL_POSITION
+        """, (table,))
+        return [row[0] for row in rows]
+
+    def primary_key(self, table):
+        rows = self.fetch_query("""
+            SELECT k.COLUMN_NAME
+            FROM INFORMATION_SCHEMA.TABLE_CONSTRAINTS c
+            JOIN INFORMATION_SCHEMA.KEY_COLUMN_USAGE k
+                ON k.CONSTRAINT_NAME = c.CONSTRAINT_NAME AND k.TABLE_SCHEMA = c.TABLE_SCHEMA AND k.TABLE_NAME = c.TABLE_NAME
+            WHERE c.CONSTRAINT_TYPE = 'PRIMARY KEY' AND c.TABLE_SCHEMA = 'dbo' AND c.TABLE_NAME = ?
+            ORDER BY k.ORDINAL_POSITION
+        """, (table,))
+        return [row[0] for row in rows]
+
+    def backup(self, table):
+        backup_columns = {column.lower() for column in self.table_columns(f"b_{table}")}
+        fields = [column for column in self.table_columns(table) if column.lower() in backup_columns]
+        key = [column for column in self.primary_key(table) if column.lower() in backup_columns]
+
+        if self.backup_mode != "incremental" or not key:
+            self.gen_query(f"TRUNCATE TABLE b_{table};")
+            self.gen_query(f"INSERT INTO b_{table} SELECT * FROM dbo.{table};")
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} - b_{table}: full copy")
+            return
+
+        compare = [field for field in fields if field not in key]
+        matched = f"""
+                WHEN MATCHED AND EXISTS (SELECT {", ".join([f"s.{field}" for field in compare])} EXCEPT SELECT {", ".join([f"t.{field}" for field in compare])}) THEN
+                    UPDATE SET {", ".join([f"{field}=s.{field}" for field in compare])}""" if compare else ""
+        query = f"""
+            SET NOCOUNT ON;
+            DECLARE @changes TABLE (Action NVARCHAR(10));
+
+            MERGE dbo.b_{table} AS t
+            USING dbo.{table} AS s
+            ON {" AND ".join([f"t.{field} = s.{field}" for field in key])}{matched}
+            WHEN NOT MATCHED BY TARGET THEN
+                INSERT ({", ".join(fields)}) VALUES ({", ".join([f"s.{field}" for field in fields])})
+            WHEN NOT MATCHED BY SOURCE THEN
+                DELETE
+            OUTPUT $action INTO @changes;
+
+            SELECT
+                COUNT(CASE WHEN Action = 'INSERT' THEN 1 END),
+                COUNT(CASE WHEN Action = 'UPDATE' THEN 1 END),
+                COUNT(CASE WHEN Action = 'DELETE' THEN 1 END)
+            FROM @changes;
+        """
 
-    def gen_query(self, query, params=None):
-        connection = pyodbc.connect(self.db_conn, autocommit=False)
-        cursor = connection.cursor()
-        cursor.fast_executemany = True
+        def run(connection):
+            cursor = connection.cursor()
+            cursor.execute(query)
+            counts = cursor.fetchone()
+            cursor.connection.commit()
+            return counts
 
-        if params:
-            cursor.execute(query, params)
+        inserted, updated, deleted = self.pool.run(run)
+        print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} - b_{table}: {inserted} inserted, {updated} updated, {deleted} deleted")
+
+    def setup(self):
+        for table, query in self.sync_tables.items():
+            self.gen_query(f"IF OBJECT_ID('dbo.{table}') IS NULL {query}")
+        self.load_widths()
+
+    def load_widths(self, table=None, cursor=None):
+        query = """
+            SELECT TABLE_SCHEMA, TABLE_NAME, COLUMN_NAME, DATA_TYPE, CHARACTER_MAXIMUM_LENGTH
+            FROM INFORMATION_SCHEMA.COLUMNS
+            WHERE CHARACTER_MAXIMUM_LENGTH IS NOT NULL
+        """
+        if table:
+            rows = self.fetch_query(query + " AND TABLE_NAME = ?", (table,), cursor=cursor)
         else:
-            cursor.execute(query)
-        cursor.connection.commit()
+            rows = self.fetch_query(query, cursor=cursor)
+            self.widths = {}
+
+        widths = {}
+        for schema, table_name, column, data_type, length in rows:
+            widths.setdefault((schema.lower(), table_name.lower()), {})[column.lower()] = (data_type, length)
+        self.widths.update(widths)
+
+    def fetch_query(self, query, params=None, commit=False, cursor=None):
+        def execute(cursor):
+            if params:
+                cursor.execute(query, params)
+            else:
+                cursor.execute(query)
+            rows = cursor.fetchall()
+            if commit:
+                cursor.connection.commit()
+            return rows
+
+        def run(connection):
+            return execute(connection.cursor())
+
+        # Writers pass the cursor they already hold so a lookup never waits on a second pooled connection.
+        if cursor is not None:
+            return execute(cursor)
+        return self.pool.run(run)
+
+    def foreign_keys(self):
+        return self.fetch_query("""
+            SELECT OBJECT_NAME(parent_object_id), OBJECT_NAME(referenced_object_id)
+            FROM sys.foreign_keys
+            WHERE OBJECT_SCHEMA_NAME(parent_object_id) = 'dbo' AND OBJECT_SCHEMA_NAME(referenced_object_id) = 'dbo';
+        """)
+
+    def get_watermark(self, api, endpoint):
+        rows = self.fetch_query("SELECT Watermark FROM sync_watermarks WHERE Api = ? AND Endpoint = ?;", (api, endpoint))
+        return rows[0][0] if rows else None
+
+    def set_watermark(self, api, endpoint, watermark):
+        self.gen_query("""
+            MERGE sync_watermarks AS t
+            USING (SELECT ? AS Api, ? AS Endpoint, ? AS Watermark) AS s
+            ON t.Api = s.Api AND t.Endpoint = s.Endpoint
+            WHEN MATCHED AND t.Watermark < s.Watermark THEN
+                UPDATE SET Watermark = s.Watermark, Updated = SYSUTCDATETIME()
+            WHEN NOT MATCHED BY TARGET THEN
+                INSERT (Api, Endpoint, Watermark, Updated) VALUES (s.Api, s.Endpoint, s.Watermark, SYSUTCDATETIME());
+        """, (api, endpoint, watermark))
+
+    def get_fingerprint(self, api, endpoint):
+        rows = self.fetch_query("SELECT Fingerprint, Checked FROM sync_fingerprints WHERE Api = ? AND Endpoint = ?;", (api, endpoint))
+        return tuple(rows[0]) if rows else None
+
+    def set_fingerprint(self, api, endpoint, fingerprint, checked):
+        self.gen_query("""
+            MERGE sync_fingerprints AS t
+            USING (SELECT ? AS Api, ? AS Endpoint, ? AS Fingerprint, ? AS Checked) AS s
+            ON t.Api = s.Api AND t.Endpoint = s.Endpoint
+            WHEN MATCHED THEN
+                UPDATE SET Fingerprint = s.Fingerprint, Checked = s.Checked
+            WHEN NOT MATCHED BY TARGET THEN
+                INSERT (Api, Endpoint, Fingerprint, Checked) VALUES (s.Api, s.Endpoint, s.Fingerprint, s.Checked);
+        """, (api, endpoint, fingerprint, checked))
+
+    def executemany(self, query, rows):
+        def run(connection):
+            cursor = connection.cursor()
+            cursor.fast_executemany = True
+            cursor.executemany(query, rows)
+            cursor.connection.commit()
 
-        connection.close()
+        self.pool.run(run)
 
-    @staticmethod
-    def alter_query(table, col, length, staging=None):
-        length = "MAX" if length > 8000 else math.ceil(length / 100) * 100
-        schemas = ["staging", "dbo"] if staging else ["dbo"]
+    def gen_query(self, query, params=None):
+        def run(connection):
+            cursor = connection.cursor()
+            cursor.fast_executemany = True
 
-        statements = []
-        for schema in schemas:
-            statements.append(f"ALTER TABLE {schema}.{table} ALTER COLUMN {col} VARCHAR({length});")
+            if params:
+                cursor.execute(query, params)
+            else:
+                cursor.execute(query)
+            cursor.connection.commit()
 
-        return statements
+        self.pool.run(run)
 
     @staticmethod
-    def col_length(cursor, table, col):
-        query = """
-            SELECT CHARACTER_MAXIMUM_LENGTH
-            FROM INFORMATION_SCHEMA.COLUMNS
-            WHERE TABLE_NAME = ? AND COLUMN_NAME = ?
-        """
-        cursor.execute(query, (table, col))
-        length = cursor.fetchone()[0]
-        return length if length else None
+    def alter_query(schema, table, col, length, data_type="varchar"):
+        limit = 4000 if data_type.lower().startswith("n") else 8000
+        length = -1 if length > limit else min(limit, math.ceil(length / 100) * 100)
+        return f"ALTER TABLE {schema}.{table} ALTER COLUMN {col} {data_type.upper()}({'MAX' if length == -1 else length});", length
 
     def upsert(self, table, fields, id_field=None, schema=None):
         placeholders = ", ".join(["?"] * len(fields))
         fields_list = ", ".join(fields)
         set_clause = ", ".join([f"{field}=s.{field}" for field in fields])
         values = ", ".join([f"s.{field}" for field in fields])
+        keys = [id_field] if isinstance(id_field, str) else list(id_field or [])
+        compare = [field for field in fields if field not in keys]
+        matched = f"""
+                WHEN MATCHED AND EXISTS (SELECT {", ".join([f"s.{field}" for field in compare])} EXCEPT SELECT {", ".join([f"t.{field}" for field in compare])}) THEN
+                    UPDATE SET {set_clause}""" if compare else ""
         
         if schema:
             return f"INSERT INTO {schema}.{table} ({fields_list}) VALUES ({placeholders});"
         else:
             return f"""
+                SET NOCOUNT ON;
+                DECLARE @changes TABLE (Action NVARCHAR(10));
+
                 MERGE dbo.{table} AS t
                 USING staging.{table} AS s
-                ON t.{id_field} = s.{id_field}
-                WHEN MATCHED THEN
-                    UPDATE SET {set_clause}
+                ON {" AND ".join([f"t.{key} = s.{key}" for key in keys])}{matched}
                 WHEN NOT MATCHED BY TARGET THEN
-                    INSERT ({fields_list}) VALUES ({values});
+                    INSERT ({fields_list}) VALUES ({values})
+                OUTPUT $action INTO @changes;
+
+                SELECT
+                    (SELECT COUNT(*) FROM staging.{table}),
+                    COUNT(CASE WHEN Action = 'INSERT' THEN 1 END),
+                    COUNT(CASE WHEN Action = 'UPDATE' THEN 1 END)
+                FROM @changes;
             """
 
-    def write_data(self, data, table, fields, i_query, m_query=None, id_field=None, ids=None):
-        connection = pyodbc.connect(self.db_conn, autocommit=False)
-        cursor = connection.cursor()
-        cursor.fast_executemany = True
-
-        if not m_query:
-            if id_field:
-                cursor.execute(f"DELETE FROM {table} WHERE {id_field} IN ({','.join(['?'] * len(ids))})", ids)
-                cursor.connection.commit()
-            else:    
-                cursor.execute(f"DELETE FROM {table};")
+    def writer(self, table, fields, i_query, m_query=None, id_field=None, bulk=False, scope=None):
+        return Writer(self, table, fields, i_query, m_query, id_field, bulk, scope)
+
+    def write_data(self, data, table, fields, i_query, m_query=None, id_field=None, ids=None, bulk=False, scope=None):
+        self.writer(table, fields, i_query, m_query, id_field, bulk, scope).write(data, ids)
+
+    def tenant_column(self, table):
+        if table in self.tenant_tables:
+            return
+
+        # Rows from before multi-tenant sync belong to the single tenant the old version saved in xeroAccess; with no single tenant there they stay NULL.
+        for schema in ("dbo", "staging"):
+            self.gen_query(f"""
+                IF OBJECT_ID('{schema}.{table}') IS NOT NULL AND COL_LENGTH('{schema}.{table}', 'TenantID') IS NULL
+                BEGIN
+                    ALTER TABLE {schema}.{table} ADD TenantID VARCHAR(36) NULL;
+                    IF (SELECT COUNT(DISTINCT Tenant_ID) FROM xeroAccess) = 1
+                        EXEC sp_executesql N'UPDATE {schema}.{table} SET TenantID = (SELECT MIN(Tenant_ID) FROM xeroAccess) WHERE TenantID IS NULL';
+                END
+            """)
+        self.tenant_tables.add(table)
+
+class Writer:
+    field_terminator = "|#|"
+    row_terminator = "|#|\r\n"
+
+    def __init__(self, db: Database, table, fields, i_query, m_query=None, id_field=None, bulk=False, scope=None):
+        self.db = db
+        self.table = table
+        self.fields = fields
+        self.i_query = i_query
+        self.m_query = m_query
+        self.id_field = id_field
+        self.scope = scope
+        self.bulk = bulk and db.bcp is not None
+        self.started = False
+        self.failed = False
+        self.counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+
+    def write(self, data, ids=None):
+        metrics = self.db.metrics
+        metrics.add("rows_flattened", len(data), table=self.table)
+
+        start = time.perf_counter()
+        with self.db.pool.connection() as connection:
+            metrics.add("connection_wait_seconds", time.perf_counter() - start, table=self.table)
+            cursor = connection.cursor()
+            cursor.fast_executemany = True
+            with metrics.timer("write_seconds", table=self.table):
+                self.load(cursor, data, ids)
+
+    def load(self, cursor, data, ids=None):
+        table = self.table
+
+        if not self.started:
+            self.started = True
+            if not self.m_query and not self.id_field:
+                if self.scope:
+                    cursor.execute(f"DELETE FROM {table} WHERE {self.scope[0]} = ?;", (self.scope[1],))
+                else:
+                    cursor.execute(f"DELETE FROM {table};")
                 cursor.connection.commit()
 
-        max_retry=2
-        batch_size = 1000
-        for i in range(0, len(data), batch_size):
-            batch = data[i:i + batch_size]
-            attempt = 0
-            
-            while attempt < max_retry: 
-                try:
-                    cursor.executemany(i_query, batch)
-                    cursor.connection.commit()
-                    break
-                except Exception as e:
-                    if attempt == 0 and "truncation" in str(e).lower():
-                        max_lengths = {}
-                        for row in batch:
-                            for idx, value in enumerate(row):
-                                if isinstance(value, str) and len(value) > 255:
-                                    col = fields[idx]
-                                    max_lengths[col] = max(max_lengths.get(col, 0), len(value)) 
-
-                        for col, length in max_lengths.items():
-                            current_len = self.col_length(cursor, table, col)
-                            if current_len and current_len < length:
-                                if m_query:
-                                    queries = self.alter_query(table, col, length, staging=True)
-                                else:
-                                    queries = self.alter_query(table, col, length)
-                                for query in queries:
-                                    cursor.execute(query)
-                                cursor.connection.commit()
-   
-                    if attempt == 1:
-                        print(f"{table} error: {e}") 
-                    cursor.connection.rollback()
-                    attempt += 1
+        if data:
+            self.widen(cursor, data)
 
-        if m_query:
-            cursor.execute(m_query)
-            cursor.connection.commit()
+        if ids is not None and not self.m_query and self.id_field:
+            self.refresh(cursor, data, ids)
+            return
+
+        merge = bool(data)
+        lock = bool(self.m_query and merge)
+        if lock:
+            cursor.execute("EXEC sp_getapplock @Resource = ?, @LockMode = 'Exclusive', @LockOwner = 'Session';", (f"staging.{table}",))
             cursor.execute(f"TRUNCATE TABLE staging.{table};")
             cursor.connection.commit()
+        try:
+            if self.bulk and data:
+                try:
+                    if self.bulk_load(cursor, data):
+                        self.db.metrics.add("rows_written", len(data), table=table)
+                        data = []
+                except RuntimeError as e:
+                    self.fail(e)
+                    data = []
+
+            max_retry=2
+            batch_size = 1000
+            for i in range(0, len(data), batch_size):
+                batch = data[i:i + batch_size]
+                attempt = 0
+            
+                while attempt < max_retry: 
+                    try:
+                        cursor.executemany(self.i_query, batch)
+                        cursor.connection.commit()
+                        self.db.metrics.add("rows_written", len(batch), table=table)
+                        break
+                    except Exception as e:
+                        cursor.connection.rollback()
+                        if isinstance(e, pyodbc.IntegrityError):
+                            self.insert_rows(cursor, batch)
+                            break
+                        if attempt == 0 and "truncation" in str(e).lower():
+                            self.widen(cursor, batch, reload=True)
+   
+                        if attempt == 1:
+                            self.fail(e)
+                        attempt += 1
+
+            if self.m_query and merge:
+                with self.db.metrics.timer("merge_seconds", table=table):
+                    cursor.execute(self.m_query)
+                    staged, inserted, updated = cursor.fetchone()
+                    cursor.connection.commit()
+                self.counts["inserted"] += inserted
+                self.counts["updated"] += updated
+                self.counts["unchanged"] += staged - inserted - updated
+                self.db.metrics.add("rows_inserted", inserted, table=table)
+                self.db.metrics.add("rows_updated", updated, table=table)
+                self.db.metrics.add("rows_unchanged", staged - inserted - updated, table=table)
+                cursor.execute(f"TRUNCATE TABLE staging.{table};")
+                cursor.connection.commit()
+        finally:
+            if lock:
+                cursor.execute("EXEC sp_releaseapplock @Resource = ?, @LockOwner = 'Session';", (f"staging.{table}",))
+
+    def refresh(self, cursor, data, ids):
+        keys = f"#keys_{self.table}"
+        ids = [(id,) for id in set(ids) if id is not None]
+        if not ids:
+            return
+
+        strict = True
+        for attempt in range(3):
+            try:
+                cursor.execute(f"IF OBJECT_ID('tempdb..{keys}') IS NOT NULL DROP TABLE {keys};")
+                cursor.execute(f"SELECT TOP 0 {self.id_field} AS id INTO {keys} FROM dbo.{self.table};")
+                cursor.executemany(f"INSERT INTO {keys} (id) VALUES (?);", ids)
+                if self.scope:
+                    cursor.execute(f"DELETE t FROM dbo.{self.table} AS t INNER JOIN {keys} AS k ON t.{self.id_field} = k.id WHERE t.{self.scope[0]} = ?;", (self.scope[1],))
+                else:
+                    cursor.execute(f"DELETE t FROM dbo.{self.table} AS t INNER JOIN {keys} AS k ON t.{self.id_field} = k.id;")
+
+                if not strict:
+                    self.insert_rows(cursor, data)
+                    return
+
+                batch_size = 1000
+                for i in range(0, len(data), batch_size):
+                    cursor.executemany(self.i_query, data[i:i + batch_size])
 
-        connection.close()
+                cursor.connection.commit()
+                self.db.metrics.add("rows_written", len(data), table=self.table)
+                return
+            except Exception as e:
+                cursor.connection.rollback()
+                if attempt == 0 and "truncation" in str(e).lower():
+                    self.widen(cursor, data, reload=True)
+                    continue
+                if strict and isinstance(e, pyodbc.IntegrityError):
+                    strict = False
+                    continue
+                self.fail(e)
+                return
+
+    def insert_rows(self, cursor, rows):
+        # A batch failed a key or foreign key check; insert row by row so only the offending rows are lost, and report them.
+        rejected = []
+        for row in rows:
+            try:
+                cursor.execute(self.i_query, row)
+            except pyodbc.IntegrityError as e:
+                rejected.append((row, e))
+        cursor.connection.commit()
+
+        self.db.metrics.add("rows_written", len(rows) - len(rejected), table=self.table)
+        if rejected:
+            self.db.metrics.add("rows_rejected", len(rejected), table=self.table)
+            row, error = rejected[0]
+            self.fail(f"{len(rejected)} of {len(rows)} rows rejected, first {row[:2]}: {error}")
+
+    def fail(self, error):
+        self.failed = True
+        self.db.metrics.add("write_errors", table=self.table)
+        print(f"{self.table} error: {error}")
+
+    def widen(self, cursor, rows, reload=False):
+        if reload:
+            self.db.load_widths(self.table, cursor)
+
+        schemas = ["staging", "dbo"] if self.m_query else ["dbo"]
+        widths = [self.db.widths.get((schema, self.table.lower()), {}) for schema in schemas]
+
+        statements = []
+        for col, values in zip(self.fields, zip(*rows)):
+            length = max((len(value) for value in values if value.__class__ is str), default=0)
+            for schema, width in zip(schemas, widths):
+                data_type, current = width.get(col.lower(), (None, None))
+                if current and current != -1 and current < length:
+                    query, new = self.db.alter_query(schema, self.table, col, length, data_type)
+                    statements.append(query)
+                    width[col.lower()] = (data_type, new)
+
+        if statements:
+            try:
+                cursor.execute("\n".join(statements))
+                cursor.connection.commit()
+            except Exception as e:
+                cursor.connection.rollback()
+                self.db.load_widths(self.table, cursor)
+                print(f"{self.table} error: {e}")
+
+    def report(self):
+        if self.started and self.m_query:
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} - {self.table}: {self.counts['inserted']} inserted, {self.counts['updated']} updated, {self.counts['unchanged']} unchanged")
+
+    @staticmethod
+    def bcp_value(value):
+        if value is None:
+            return ""
+        if isinstance(value, bool):
+            return "1" if value else "0"
+        if isinstance(value, (datetime.date, datetime.datetime)):
+            return value.isoformat()
+        return str(value)
+
+    def bulk_load(self, cursor, data):
+        args, password = self.db.bcp_args()
+        if args is None:
+            return False
+
+        schema = "staging" if self.m_query else "dbo"
+        columns = self.db.column_order(schema, self.table, cursor)
+        if any(field.lower() not in columns for field in self.fields):
+            return False
+
+        with tempfile.TemporaryDirectory() as tmp:
+            fmt_file = os.path.join(tmp, "format.fmt")
+            data_file = os.path.join(tmp, "data.txt")
+
+            with open(fmt_file, "w") as f:
+                f.write(f"14.0\n{len(self.fields)}\n")
+                for idx, field in enumerate(self.fields, 1):
+                    terminator = self.row_terminator if idx == len(self.fields) else self.field_terminator
+                    terminator = terminator.replace("\r", "\\r").replace("\n", "\\n")
+                    f.write(f'{idx}\tSQLCHAR\t0\t0\t"{terminator}"\t{columns[field.lower()]}\t{field}\t""\n')
+
+            with open(data_file, "w", encoding="utf-8", newline="") as f:
+                for row in data:
+                    values = [self.bcp_value(value) for value in row]
+                    if any(self.field_terminator in value for value in values):
+                        return False
+                    f.write(self.field_terminator.join(values) + self.row_terminator)
+
+            try:
+                result = subprocess.run(
+                    [self.db.bcp, f"{schema}.{self.table}", "in", data_file, "-f", fmt_file, "-k", "-m", "1", "-h", "TABLOCK"] + args,
+                    input=password + "\n", capture_output=True, text=True, timeout=self.db.bcp_timeout
+                )
+            except subprocess.TimeoutExpired:
+                # bcp was killed mid-copy, so how many rows it committed is unknown; falling back to executemany could insert them twice.
+                raise RuntimeError(f"bcp into {schema}.{self.table} timed out after {self.db.bcp_timeout}s")
+
+        copied = re.search(r"(\d+) rows copied", result.stdout)
+        copied = int(copied.group(1)) if copied else 0
+        if 0 < copied < len(data):
+            # The copied rows are committed, so falling back to executemany would insert them twice.
+            raise RuntimeError(f"bcp copied {copied} of {len(data)} rows into {schema}.{self.table}")
+        return result.returncode == 0 and copied == len(data)
+
+class Archive:
+    def __init__(self):
+        with open("config.json", "r") as f:
+            config = json.load(f)
+
+        self.enabled = config.get("Archive", {}).get("enabled", False)
+        self.dir = config.get("Archive", {}).get("dir", "archive")
+        self.replay = False
+        self.lock = threading.Lock()
+        self.conn = None
+        self.latest = {}
+
+    def connect(self):
+        if self.conn is None:
+            os.makedirs(self.dir, exist_ok=True)
+            self.conn = sqlite3.connect(os.path.join(self.dir, "index.sqlite"), check_same_thread=False)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS items (api TEXT, endpoint TEXT, tenant TEXT, id TEXT, modified TEXT, sha TEXT, seen INTEGER, PRIMARY KEY (api, endpoint, tenant, id, sha));")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS items_seen ON items (api, endpoint, tenant, id, seen);")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS snapshots (api TEXT, endpoint TEXT, tenant TEXT, started INTEGER, PRIMARY KEY (api, endpoint, tenant));")
+            self.conn.commit()
+        return self.conn
+
+    def path(self, sha):
+        return os.path.join(self.dir, "objects", sha[:2], sha + ".json.gz")
+
+    def snapshot(self, api, endpoint, tenant=""):
+        with self.lock:
+            conn = self.connect()
+            conn.execute("INSERT INTO snapshots (api, endpoint, tenant, started) VALUES (?, ?, ?, ?) ON CONFLICT (api, endpoint, tenant) DO UPDATE SET started = excluded.started;", (api, endpoint, tenant, time.time_ns()))
+            conn.commit()
+
+    def store(self, api, endpoint, items, key=None, tenant=""):
+        rows = []
+        seen = time.time_ns()
+        for item in items:
+            body = json.dumps(item, sort_keys=True, separators=(",", ":")).encode()
+            sha = hashlib.sha256(body).hexdigest()
+            path = self.path(sha)
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp = f"{path}.{threading.get_ident()}.tmp"
+                with gzip.open(tmp, "wb") as f:
+                    f.write(body)
+                os.replace(tmp, path)
+
+            values = [item.get(field) for field in key or []]
+            id = "|".join(str(value) for value in values) if any(value is not None for value in values) else sha
+            modified = next((str(item[field]) for field in Process.watermark_fields if item.get(field)), None)
+            rows.append((api, endpoint, tenant, id, modified, sha, seen))
+
+        with self.lock:
+            conn = self.connect()
+            conn.executemany("INSERT INTO items (api, endpoint, tenant, id, modified, sha, seen) VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (api, endpoint, tenant, id, sha) DO UPDATE SET modified = excluded.modified, seen = excluded.seen;", rows)
+            conn.commit()
+
+    def keys(self, api, endpoint, tenant=""):
+        with self.lock:
+            if (api, endpoint, tenant) not in self.latest:
+                conn = self.connect()
+                # Endpoints without a unique key are archived as snapshots: only items seen since the last snapshot started are replayed.
+                started = conn.execute("SELECT started FROM snapshots WHERE api = ? AND endpoint = ? AND tenant = ?;", (api, endpoint, tenant)).fetchone()
+                rows = conn.execute("""SELECT id, sha FROM items i WHERE api = ? AND endpoint = ? AND tenant = ? AND seen >= ?
+                    AND seen = (SELECT MAX(seen) FROM items j WHERE j.api = i.api AND j.endpoint = i.endpoint AND j.tenant = i.tenant AND j.id = i.id)
+                    ORDER BY id;""", (api, endpoint, tenant, started[0] if started else 0)).fetchall()
+                self.latest[(api, endpoint, tenant)] = dict(rows)
+            return self.latest[(api, endpoint, tenant)]
+
+    def tenants(self, api):
+        with self.lock:
+            return [row[0] for row in self.connect().execute("SELECT DISTINCT tenant FROM items WHERE api = ? ORDER BY tenant;", (api,)).fetchall()]
+
+    def load(self, sha):
+        with gzip.open(self.path(sha), "rb") as f:
+            return json.loads(f.read())
+
+    def page(self, api, endpoint, page, tenant=""):
+        shas = list(self.keys(api, endpoint, tenant).values())[(page - 1) * 1000:page * 1000]
+        return [self.load(sha) for sha in shas]
+
+    def record(self, api, endpoint, id, tenant=""):
+        sha = self.keys(api, endpoint, tenant).get(str(id))
+        return self.load(sha) if sha else {}
+
+class ArchiveCin7CoreApi(Cin7CoreApi):
+    def __init__(self, archive: Archive, http: HttpClient=None, metrics: Metrics=None):
+        super().__init__(http, metrics)
+        self.archive = archive
+        self.list_fields = {cfg.get("endpoint"): cfg.get("list_field") for cfg in self.config}
+
+    async def get_data(self, data_type, endpoint, page=None, params=None, key=None, id=None):
+        if data_type == "record":
+            return await asyncio.to_thread(self.archive.record, "cin7core", endpoint, id)
+        if data_type == "page":
+            return math.ceil(len(await asyncio.to_thread(self.archive.keys, "cin7core", endpoint)) / 1000)
+        return {self.list_fields.get(endpoint): await asyncio.to_thread(self.archive.page, "cin7core", endpoint, page)}
+
+class ArchiveXeroApi(XeroApi):
+    def __init__(self, archive: Archive, http: HttpClient=None, metrics: Metrics=None):
+        super().__init__(http, metrics)
+        self.archive = archive
+
+    async def access(self, delay=0, stale=None):
+        return None, await asyncio.to_thread(self.archive.tenants, "xero")
+
+    async def get_data(self, data_type, tenant, endpoint, start_date=None, page=None):
+        if data_type == "page":
+            return math.ceil(len(await asyncio.to_thread(self.archive.keys, "xero", endpoint, tenant)) / 1000)
+        if data_type == "paged":
+            return await asyncio.to_thread(self.archive.page, "xero", endpoint, page, tenant)
+        return [await asyncio.to_thread(self.archive.load, sha) for sha in (await asyncio.to_thread(self.archive.keys, "xero", endpoint, tenant)).values()]
 
 class Process:
-    def __init__(self, db: Database, cin7core: Cin7CoreApi=None, xero: XeroApi=None):
+    watermark_fields = ("LastModifiedOn", "Updated", "LastUpdatedDate", "UpdatedDateUTC")
+
+    def __init__(self, db: Database, cin7core: Cin7CoreApi=None, xero: XeroApi=None, archive: Archive=None):
+        with open("config.json", "r") as f:
+            config = json.load(f)
+
         self.db = db
         self.cin7coreapi = cin7core
         self.xeroapi = xero        
+        self.archive = archive
+        self.page_concurrency = config.get("Sync", {}).get("page_concurrency", 4)
+        self.record_concurrency = config.get("Sync", {}).get("record_concurrency", 4)
+        self.checkpoint_dir = config.get("Sync", {}).get("checkpoint_dir", "checkpoints")
+        self.checkpoint_max_age = config.get("Sync", {}).get("checkpoint_max_age", 24) * 3600
+        self.chunk_size = config.get("Sync", {}).get("chunk_size", 500)
+        self.entry_workers = config.get("Sync", {}).get("entry_workers", 6)
+        self.nocheck = config.get("Sync", {}).get("nocheck", False)
+        self.watermark_overlap = datetime.timedelta(minutes=config.get("Sync", {}).get("watermark_overlap", 10))
+        self.flatten_workers = config.get("Sync", {}).get("flatten_workers", min(4, os.cpu_count() or 1))
+        self.flatten_pool = None
+
+    async def fan_out(self, fetch, first, last):
+        window = collections.deque()
+        page = first
+        try:
+            while page <= last or window:
+                while page <= last and len(window) < self.page_concurrency:
+                    window.append(asyncio.create_task(fetch(page)))
+                    page += 1
+                yield await window.popleft()
+        finally:
+            for task in window:
+                task.cancel()
+
+    @staticmethod
+    def parse_watermark(value):
+        if not isinstance(value, str):
+            return None
+
+        match = re.match(r"/Date\((-?\d+)", value)
+        if match:
+            return datetime.datetime.fromtimestamp(int(match.group(1)) / 1000, datetime.timezone.utc).replace(tzinfo=None)
+
+        try:
+            value = datetime.datetime.fromisoformat(value)
+        except ValueError:
+            return None
+        if value.tzinfo:
+            value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return value
+
+    def high_water(self, high, items, field=None):
+        for item in items:
+            for key in ([field] if field else self.watermark_fields):
+                value = self.parse_watermark(item.get(key))
+                if value:
+                    if high is None or value > high:
+                        high = value
+                    break
+        return high
+
+    async def start_from(self, api, endpoint, start_date):
+        watermark = await asyncio.to_thread(self.db.get_watermark, api, endpoint)
+        if watermark:
+            return (watermark - self.watermark_overlap).replace(microsecond=0).isoformat()
+        return start_date
+
+    async def archive_items(self, api, endpoint, items, key=None, tenant=""):
+        if self.archive and not self.archive.replay and items:
+            await asyncio.to_thread(self.archive.store, api, endpoint, items, key, tenant)
+
+    async def archive_snapshot(self, api, endpoint, key=None):
+        if self.archive and not self.archive.replay and not key:
+            await asyncio.to_thread(self.archive.snapshot, api, endpoint)
+
+    async def covered(self, table, list_field, responses):
+        pages = [response async for response in responses]
+        archived = sum(len(response.get(list_field, [])) for response in pages)
+        existing = (await asyncio.to_thread(self.db.fetch_query, "SELECT COALESCE(SUM(rows), 0) FROM sys.partitions WHERE object_id = OBJECT_ID(?) AND index_id IN (0, 1);", (f"dbo.{table}",)))[0][0]
+        if existing > archived:
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} - WARNING: {table} holds {existing} rows but the archive only {archived}, table left as it is")
+            return None
+
+        async def replay():
+            for page in pages:
+                yield page
+
+        return replay()
+
+    async def fingerprinted(self, stored, request, responses):
+        pages = [response async for response in responses]
+        digest = hashlib.sha256(json.dumps([request, pages], sort_keys=True, default=str).encode()).hexdigest()
+        if stored and stored[0] == digest:
+            return None, digest
+
+        async def replay():
+            for page in pages:
+                yield page
+
+        return replay(), digest
+
+    async def unchanged(self, api, endpoint, digest, checked):
+        if digest:
+            await asyncio.to_thread(self.db.set_fingerprint, api, endpoint, digest, checked)
+        self.db.metrics.add("fingerprint_skips", api=api, endpoint=endpoint)
+        print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} - {api} {endpoint} unchanged, skipped")
+
+    def written(self, endpoint, writers, unit=None):
+        failed = [writer.table for writer in writers if writer.failed]
+        if failed and unit:
+            raise RuntimeError(f"Write errors in {', '.join(failed)}")
+        if failed:
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} - {endpoint}: write errors in {', '.join(failed)}, watermark not advanced")
+        return not failed
+
+    async def save_watermark(self, api, endpoint, high):
+        if high and not (self.archive and self.archive.replay):
+            await asyncio.to_thread(self.db.set_watermark, api, endpoint, high)
+
+    def checkpoint(self, endpoint):
+        return os.path.join(self.checkpoint_dir, f"{endpoint.replace('/', '_')}_full.ndjson")
+
+    def load_checkpoint(self, checkpoint):
+        done = set()
+        if os.path.exists(checkpoint) and time.time() - os.path.getmtime(checkpoint) < self.checkpoint_max_age:
+            with open(checkpoint, "r") as f:
+                for line in f:
+                    try:
+                        done.add(json.loads(line))
+                    except ValueError:
+                        continue
+        return done
+
+    def save_checkpoint(self, checkpoint, ids):
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        with open(checkpoint, "a") as f:
+            for id in ids:
+                f.write(json.dumps(id) + "\n")
+
+    def chunks(self, items):
+        for i in range(0, len(items), self.chunk_size):
+            yield items[i:i + self.chunk_size]
+
+    async def fetch_records(self, endpoint, ids, params, key):
+        records = {}
+        queue = asyncio.Queue()
+        for id in ids:
+            queue.put_nowait(id)
+
+        async def worker():
+            while True:
+                try:
+                    id = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                records[id] = await self.cin7coreapi.get_data("record", endpoint, params=params, key=key, id=id)
+
+        await asyncio.gather(*[worker() for _ in range(min(self.record_concurrency, queue.qsize()))])
+
+        return [records[id] for id in ids]
+
+    def record_plan(self, value):
+        fields = value.get("fields")
+        return self.cin7coreapi.compile(fields, value.get("date_fields", []), parent=fields[0], fields2=value.get("nest2_fields", []), fields3=value.get("nest3_fields", []))
+
+    @staticmethod
+    def record_rows(api_data, specs, id_field):
+        field_list = Cin7CoreApi.field_list
+        nests = {}
+        for idx, (nest, nest2, nest3, plan) in enumerate(specs):
+            nests.setdefault(nest, []).append((idx, nest2, nest3, plan))
+
+        tables = [[] for _ in specs]
+        for item in api_data:
+            id = item.get(id_field)
+
+            for nest, values in nests.items():
+                records = item.get(nest, [])
+                records = records if isinstance(records, list) else [records]
+
+                for record in records:
+                    for idx, nest2, nest3, plan in values:
+                        data = tables[idx]
+                        if nest2 is None:
+                            data.append(field_list(plan, record, id))
+                            continue
+
+                        records2 = record.get(nest2, [])
+                        records2 = records2 if isinstance(records2, list) else [records2]
+
+                        for record2 in records2:
+                            if nest3 is None:
+                                data.append(field_list(plan, record, id, item2=record2))
+                            else:
+                                for record3 in record2.get(nest3, []):
+                                    data.append(field_list(plan, record, id, item2=record2, item3=record3))
+
+        return [[row for row in data if row is not None] for data in tables]
+
+    async def flatten_records(self, api_data, specs, id_field):
+        with self.db.metrics.timer("flatten_seconds", api="cin7core"):
+            if self.flatten_workers <= 0:
+                return await asyncio.to_thread(self.record_rows, api_data, specs, id_field)
+
+            if self.flatten_pool is None:
+                self.flatten_pool = concurrent.futures.ProcessPoolExecutor(self.flatten_workers)
+            return await asyncio.get_running_loop().run_in_executor(self.flatten_pool, Process.record_rows, api_data, specs, id_field)
+
+    def close(self):
+        if self.flatten_pool is not None:
+            self.flatten_pool.shutdown()
+            self.flatten_pool = None
 
     def constraints(self, cfg, mode, api):
         if api == "cin7core":
@@ -352,6 +1558,16 @@ class Process:
                     query = f"ALTER TABLE {nested_table} CHECK CONSTRAINT ALL;"
                 self.db.gen_query(query)
 
+    @staticmethod
+    def tables(cfg, api):
+        if api == "cin7core":
+            tables = [cfg["table"]] if cfg.get("table") else []
+            tables += [value["table"] for value in cfg.get("nested", []) if value.get("table")]
+        elif api == "xero":
+            tables = ["xero_" + cfg.get("endpoint", "")]
+            tables += ["xero_" + cfg.get("endpoint", "") + "_" + value.get("nest", "") for value in cfg.get("nested", [])]
+        return tables
+
     def truncate_staging(self, cfg, api):
         if api == "cin7core":
             table = cfg.get("table", None)
@@ -363,30 +1579,14 @@ class Process:
         if table and staging:
             self.db.gen_query(f"TRUNCATE TABLE staging.{table};")
 
-    def backup_func(self, cfg, api):
+    def backup_tables(self, cfg, api):
         if api == "cin7core":
-            table = cfg.get("table", None)
+            tables = [(cfg, cfg.get("table"))] + [(value, value.get("table")) for value in cfg.get("nested", [])]
         elif api == "xero":
-            table = "xero_" + cfg.get("endpoint", "")
-        backup = cfg.get("backup", False)
-        nested = cfg.get("nested", [])
-
-        if backup:
-            self.db.gen_query(f"TRUNCATE TABLE b_{table};")
-            self.db.gen_query(f"INSERT INTO b_{table} SELECT * FROM dbo.{table};")
-        else:
-            for value in nested:
-                if api == "cin7core":
-                    table = value.get("table", None)
-                elif api == "xero":
-                    table = "xero_" + value.get("endpoint", "")
-                backup = value.get("backup", False)
+            tables = [(cfg, "xero_" + cfg.get("endpoint", ""))] + [(value, "xero_" + cfg.get("endpoint", "") + "_" + value.get("nest", "")) for value in cfg.get("nested", [])]
+        return [table for value, table in tables if table and value.get("backup", False)]
 
-                if backup:
-                    self.db.gen_query(f"TRUNCATE TABLE b_{table};")
-                    self.db.gen_query(f"INSERT INTO b_{table} SELECT * FROM dbo.{table};")
-
-    async def cin7core(self, cfg, days=None):
+    async def cin7core(self, cfg, days=None, unit=None, enqueue=None):
         endpoint = cfg.get("endpoint")
         list_field = cfg.get("list_field")
         params = cfg.get("params", None)
@@ -402,10 +1602,22 @@ class Process:
         list_id = cfg.get("list_id", None)
         list_date = cfg.get("list_date", None)
         fom_date = cfg.get("fom_date", None)
+        watermark = cfg.get("watermark", None)
+        replay = bool(self.archive and self.archive.replay)
+        fingerprint = cfg.get("fingerprint", False) and not unit and not enqueue and not replay
+        checked = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None, microsecond=0)
+        digest = None
+        high = None
+        # Child rows are replaced per parent ID on incremental runs, in work units and on rebuilds, so a retried unit never duplicates them and a rebuild leaves unarchived parents alone.
+        keyed = days is not None or unit is not None or replay
+
+        use_watermark = bool(params) and "__DATE__" in params.values() and not fom_date
 
         if not id_field:
             id_field = fields[0]    
 
+        archive_key = cfg.get("archive_key") or ([id_field] if staging else None)
+
         if mod_fields:
             db_fields = self.cin7coreapi.mod_fields(fields, mod_fields)
         else:
@@ -424,6 +1636,13 @@ class Process:
             else:
                 start_date = (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=days)).replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None).isoformat()
 
+            if unit:
+                start_date = unit["start_date"]
+            elif use_watermark:
+                start_date = await self.start_from("cin7core", endpoint, start_date)
+        else:
+            start_date = None
+
         if params:
             if days is not None:
                 params = self.cin7coreapi.params(params, start_date)
@@ -431,141 +1650,197 @@ class Process:
                 params = self.cin7coreapi.params(params)
 
         if not nested: # Tables
-            pages = await asyncio.to_thread(self.cin7coreapi.get_data, "page", endpoint, page=1, params=params)
-
-            data = []
-            for page in range(1, pages + 1):
-                response = await asyncio.to_thread(self.cin7coreapi.get_data, "table", endpoint, page, params)
+            if unit:
+                first, pages = unit["first"], unit["last"]
+            else:
+                first, pages = 1, await self.cin7coreapi.get_data("page", endpoint, page=1, params=params)
+                if enqueue:
+                    return await enqueue(pages=pages, start_date=start_date)
+
+            responses = self.fan_out(lambda page: self.cin7coreapi.get_data("table", endpoint, page, params), first, pages)
+            if fingerprint:
+                stored = await asyncio.to_thread(self.db.get_fingerprint, "cin7core", endpoint)
+                responses, digest = await self.fingerprinted(stored, [cfg, params], responses)
+                if responses is None:
+                    return await self.unchanged("cin7core", endpoint, digest, checked)
+            await self.archive_snapshot("cin7core", endpoint, archive_key)
+            if replay and not m_query:
+                responses = await self.covered(table, list_field, responses)
+                if responses is None:
+                    return
+
+            plan = self.cin7coreapi.compile(fields, date_fields)
+            writer = self.db.writer(table, db_fields, i_query, m_query, bulk=cfg.get("bulk", False))
+            async for response in responses:
+                data = self.cin7coreapi.rows(plan, response.get(list_field, []))
+                await self.archive_items("cin7core", endpoint, response.get(list_field, []), archive_key)
+
+                if data:
+                    await asyncio.to_thread(writer.write, data)
+
+                if use_watermark:
+                    high = self.high_water(high, response.get(list_field, []), watermark)
+
+            writer.report()
+            written = self.written(endpoint, [writer], unit)
+            if unit:
+                return high
+            if written:
+                await self.save_watermark("cin7core", endpoint, high)
+            if digest and written:
+                await asyncio.to_thread(self.db.set_fingerprint, "cin7core", endpoint, digest, checked)
 
-                for item in response.get(list_field, []):
-                    data.append(self.cin7coreapi.field_list(item, fields, date_fields))
+        elif not endpoint_id: # Nested
+            if unit:
+                first, pages = unit["first"], unit["last"]
+            else:
+                first, pages = 1, await self.cin7coreapi.get_data("page", endpoint, page=1, params=params)
+                if enqueue:
+                    return await enqueue(pages=pages, start_date=start_date)
+
+            responses = self.fan_out(lambda page: self.cin7coreapi.get_data("table", endpoint, page, params), first, pages)
+            if fingerprint:
+                stored = await asyncio.to_thread(self.db.get_fingerprint, "cin7core", endpoint)
+                responses, digest = await self.fingerprinted(stored, [cfg, params], responses)
+                if responses is None:
+                    return await self.unchanged("cin7core", endpoint, digest, checked)
+            await self.archive_snapshot("cin7core", endpoint, archive_key)
+            if replay and not m_query:
+                responses = await self.covered(table, list_field, responses)
+                if responses is None:
+                    return
+
+            children = []
+            for value in nested:
+                nest_fields = value.get("fields")
+                nest_mod_fields = value.get("mod_fields", {})
 
-            if data:
-                await asyncio.to_thread(self.db.write_data, data, table, fields, i_query, m_query)
+                if nest_mod_fields:
+                    nest_db_fields = self.cin7coreapi.mod_fields(nest_fields, nest_mod_fields)
+                else:
+                    nest_db_fields = nest_fields
 
-        elif not endpoint_id: # Nested
-            pages = await asyncio.to_thread(self.cin7coreapi.get_data, "page", endpoint, page=1, params=params)
+                nest_i_query = self.db.upsert(value.get("table"), nest_db_fields, schema="dbo")
+                writer = self.db.writer(value.get("table"), nest_db_fields, nest_i_query, id_field=nest_fields[0] if keyed else None, bulk=value.get("bulk", False))
+                children.append((value.get("nest"), self.cin7coreapi.compile(nest_fields, value.get("date_fields", []), parent=nest_fields[0]), writer))
 
-            api_data = []
-            for page in range(1, pages + 1):
-                response = await asyncio.to_thread(self.cin7coreapi.get_data, "table", endpoint, page, params)
-                api_data.extend(response.get(list_field, []))
+            plan = self.cin7coreapi.compile(fields, date_fields)
+            writer = self.db.writer(table, db_fields, i_query, m_query, bulk=cfg.get("bulk", False))
+            async for response in responses:
+                api_data = response.get(list_field, [])
+                if not api_data:
+                    continue
 
-            if api_data:
-                data = []
-                for item in api_data:
-                    data.append(self.cin7coreapi.field_list(item, fields, date_fields))
+                data = self.cin7coreapi.rows(plan, api_data)
+                await self.archive_items("cin7core", endpoint, api_data, archive_key)
 
-                await asyncio.to_thread(self.db.write_data, data, table, fields, i_query, m_query)
+                await asyncio.to_thread(writer.write, data)
 
-                if days is not None:
+                if keyed:
                     ids = []
                     for item in api_data:
                         ids.append(item.get(id_field))
+                else:
+                    ids = None
 
-                for value in nested:
-                    nest = value.get("nest")
-                    table = value.get("table")
-                    fields = value.get("fields")
-                    mod_fields = value.get("mod_fields", {})
-                    date_fields = value.get("date_fields", [])
-                    parent = fields[0]
-
-                    if mod_fields:
-                        db_fields = self.cin7coreapi.mod_fields(fields, mod_fields)
-                    else:
-                        db_fields = fields
-
-                    i_query = self.db.upsert(table, db_fields, schema="dbo")
-                    m_query = None
-
+                for nest, nest_plan, nest_writer in children:
                     data = []
                     for item in api_data:
-                        parent_id = item.get(id_field)
-                        nested_items = item.get(nest, [])
+                        data.extend(self.cin7coreapi.rows(nest_plan, item.get(nest, []), item.get(id_field)))
 
-                        for nested_item in nested_items:
-                            data.append(self.cin7coreapi.field_list(nested_item, fields, date_fields, parent=parent, parent_id=parent_id))
-                    
-                    if data:
-                        if days is not None:
-                            await asyncio.to_thread(self.db.write_data, data, table, fields, i_query, id_field=parent, ids=ids)
-                        else:
-                            await asyncio.to_thread(self.db.write_data, data, table, fields, i_query)        
+                    if data or ids:
+                        await asyncio.to_thread(nest_writer.write, data, ids)
+
+                if use_watermark:
+                    high = self.high_water(high, api_data, watermark)
+
+            writer.report()
+            written = self.written(endpoint, [writer] + [nest_writer for nest, nest_plan, nest_writer in children], unit)
+            if unit:
+                return high
+            if written:
+                await self.save_watermark("cin7core", endpoint, high)
+            if digest and written:
+                await asyncio.to_thread(self.db.set_fingerprint, "cin7core", endpoint, digest, checked)
 
         else: # Records
-            pages = await asyncio.to_thread(self.cin7coreapi.get_data, "page", endpoint_id, page=1, params=params)
+            if unit:
+                ids = unit["ids"]
+            elif self.archive and self.archive.replay:
+                ids = list(await asyncio.to_thread(self.archive.keys, "cin7core", endpoint))
+            else:
+                pages = await self.cin7coreapi.get_data("page", endpoint_id, page=1, params=params)
 
-            if list_date and days:
-                start_list_date = datetime.datetime.fromisoformat(start_date).date()
-                
-            ids = []
-            for page in range(1, pages + 1):
-                response = await asyncio.to_thread(self.cin7coreapi.get_data, "table", endpoint_id, page, params)
+                if list_date and days:
+                    start_list_date = datetime.datetime.fromisoformat(start_date).date()
+                    
+                ids = []
+                async for response in self.fan_out(lambda page: self.cin7coreapi.get_data("table", endpoint_id, page, params), 1, pages):
+                    if use_watermark:
+                        high = self.high_water(high, response.get(list_field, []), watermark)
 
-                for id in response.get(list_field, []):
-                    if not list_date or not days:
-                        ids.append(id.get(list_id))
-                    else:
-                        update_date = datetime.datetime.fromisoformat(id.get(list_date)).date()
-                        if update_date >= start_list_date:
+                    for id in response.get(list_field, []):
+                        if not list_date or not days:
                             ids.append(id.get(list_id))
+                        else:
+                            update_date = datetime.datetime.fromisoformat(id.get(list_date)).date()
+                            if update_date >= start_list_date:
+                                ids.append(id.get(list_id))
+
+                if enqueue:
+                    return await enqueue(ids=[id for id in ids if id is not None], high=high, start_date=start_date)
 
+            writers = []
             if ids and ids != [None]: 
-                api_data = []
-                for id in ids:
-                    response = await asyncio.to_thread(self.cin7coreapi.get_data, "record", endpoint, params=params_record, key=id_field, id=id)
-                    api_data.append(response)
+                checkpoint = self.checkpoint(endpoint)
+                resume = not keyed
+                done = self.load_checkpoint(checkpoint) if resume else set()
 
+                children = []
                 for value in nested:
-                    nest = value.get("nest")
-                    nest2 = value.get("nest2", None)
-                    nest3 = value.get("nest3", None)
-                    table = value.get("table")
-                    fields = value.get("fields")
-                    mod_fields = value.get("mod_fields", {})
-                    nest2_fields = value.get("nest2_fields", [])
-                    nest3_fields = value.get("nest3_fields", [])
-                    date_fields = value.get("date_fields", [])
-                    parent = fields[0]
-
-                    if mod_fields:
-                        db_fields = self.cin7coreapi.mod_fields(fields, mod_fields)
+                    nest_fields = value.get("fields")
+                    nest_mod_fields = value.get("mod_fields", {})
+
+                    if nest_mod_fields:
+                        nest_db_fields = self.cin7coreapi.mod_fields(nest_fields, nest_mod_fields)
                     else:
-                        db_fields = fields
+                        nest_db_fields = nest_fields
 
-                    i_query = self.db.upsert(table, db_fields, schema="dbo")
-                    m_query = None
+                    nest_i_query = self.db.upsert(value.get("table"), nest_db_fields, schema="dbo")
+                    writer = self.db.writer(value.get("table"), nest_db_fields, nest_i_query, id_field=nest_fields[0] if keyed else None, bulk=value.get("bulk", False))
+                    writer.started = bool(done)
+                    children.append((value, self.record_plan(value), writer))
+                    writers.append(writer)
 
-                    data = []
-                    for item in api_data:
-                        id = item.get(id_field)
-                        records = item.get(nest, [])
-                        records = records if isinstance(records, list) else [records]
+                chunks = list(self.chunks([id for id in ids if id not in done]))
 
-                        for record in records:
-                            if nest2 is None:
-                                data.append(self.cin7coreapi.field_list(record, fields, date_fields, parent=parent, parent_id=id))
-                            else:
-                                records2 = record.get(nest2, [])
-                                records2 = records2 if isinstance(records2, list) else [records2]
+                async def fetch(i):
+                    return chunks[i - 1], await self.fetch_records(endpoint, chunks[i - 1], params_record, id_field)
 
-                                for record2 in records2:
-                                    if nest3 is None:
-                                        data.append(self.cin7coreapi.field_list(record, fields, date_fields, parent=parent, parent_id=id, item2=record2, fields2=nest2_fields))
-                                    else:
-                                        records3 = record2.get(nest3, [])
+                specs = tuple((value.get("nest"), value.get("nest2", None), value.get("nest3", None), plan) for value, plan, writer in children)
 
-                                        for record3 in records3:
-                                            data.append(self.cin7coreapi.field_list(record, fields, date_fields, parent=parent, parent_id=id, item2=record2, fields2=nest2_fields, item3=record3, fields3=nest3_fields))
+                async for chunk, api_data in self.fan_out(fetch, 1, len(chunks)):
+                    await self.archive_items("cin7core", endpoint, api_data, [id_field])
+                    tables = await self.flatten_records(api_data, specs, id_field)
+                    for (value, plan, writer), data in zip(children, tables):
+                        if keyed:
+                            await asyncio.to_thread(writer.write, data, chunk)
+                        elif data:
+                            await asyncio.to_thread(writer.write, data)
 
-                    if data:
-                        if days is not None:
-                            await asyncio.to_thread(self.db.write_data, data, table, fields, i_query, id_field=parent, ids=ids)
-                        else:
-                            await asyncio.to_thread(self.db.write_data, data, table, fields, i_query)
+                    if resume and not any(writer.failed for writer in writers):
+                        self.save_checkpoint(checkpoint, chunk)
+
+                if resume and not any(writer.failed for writer in writers) and os.path.exists(checkpoint):
+                    os.remove(checkpoint)
 
-    async def xero(self, cfg, token, tenant, days=None, start_date=None):
+            written = self.written(endpoint, writers, unit)
+            if unit:
+                return high
+            if written:
+                await self.save_watermark("cin7core", endpoint, high)
+
+    async def xero(self, cfg, tenant, days=None, start_date=None, unit=None):
         endpoint = cfg.get("endpoint")
         paged = cfg.get("paged", False)
         fields = cfg.get("fields")
@@ -573,89 +1848,222 @@ class Process:
         nested = cfg.get("nested", [])
         table = f"xero_{endpoint}"
         id_field = fields[0]
-
-        i_query = self.db.upsert(table, fields, schema="staging")
-        m_query = self.db.upsert(table, fields, id_field)
+        watermark = cfg.get("watermark", None)
+        replay = bool(self.archive and self.archive.replay)
+        fingerprint = cfg.get("fingerprint", False) and not replay
+        checked = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None, microsecond=0)
+        digest = None
+        high = None
+
+        watermark_key = f"{tenant}/{endpoint}"
+        scope = ("TenantID", tenant)
+        prefix = (tenant,)
+        keyed = days is not None or replay
+
+        use_watermark = bool(watermark) or "UpdatedDateUTC" in fields
+        if use_watermark and days is not None:
+            start_date = await self.start_from("xero", watermark_key, start_date)
+
+        db_fields = ["TenantID"] + fields
+        i_query = self.db.upsert(table, db_fields, schema="staging")
+        m_query = self.db.upsert(table, db_fields, ["TenantID", id_field])
 
         if not paged:
-            api_data = []
-            response = await asyncio.to_thread(self.xeroapi.get_data, "table", token, tenant, endpoint, start_date)
-            api_data.extend(response)
+            async def responses():
+                yield await self.xeroapi.get_data("table", tenant, endpoint, start_date)
 
         else:
-            pages = await asyncio.to_thread(self.xeroapi.get_data, "page", token, tenant, endpoint, start_date)
-
-            api_data = []
-            for page in range(1, pages + 1):
-                response = await asyncio.to_thread(self.xeroapi.get_data, "paged", token, tenant, endpoint, start_date, page=page)
-                api_data.extend(response)
+            pages = await self.xeroapi.get_data("page", tenant, endpoint, start_date)
+
+            def responses():
+                return self.fan_out(lambda page: self.xeroapi.get_data("paged", tenant, endpoint, start_date, page=page), 1, pages)
+
+        source = responses()
+        if fingerprint:
+            stored = await asyncio.to_thread(self.db.get_fingerprint, "xero", watermark_key)
+            if stored and not paged and not start_date and not await self.xeroapi.get_data("table", tenant, endpoint, stored[1].isoformat()):
+                return await self.unchanged("xero", watermark_key, None, checked)
+
+            source, digest = await self.fingerprinted(stored, [cfg, start_date], source)
+            if source is None:
+                return await self.unchanged("xero", watermark_key, digest, checked)
+
+        children = []
+        for value in nested:
+            nest_fields = value.get("fields")
+            nest_db_fields = ["TenantID"] + nest_fields
+            nest_table = f"xero_{endpoint}_{value.get('nest')}"
+            nest_i_query = self.db.upsert(nest_table, nest_db_fields, schema="dbo")
+            writer = self.db.writer(nest_table, nest_db_fields, nest_i_query, id_field=nest_fields[0] if keyed else None, bulk=value.get("bulk", False), scope=scope)
+            children.append((value.get("nest"), self.xeroapi.compile(nest_fields, value.get("date_fields", []), parent=nest_fields[0]), writer))
+
+        plan = self.xeroapi.compile(fields, date_fields)
+        writer = self.db.writer(table, db_fields, i_query, m_query, bulk=cfg.get("bulk", False), scope=scope)
+        async for api_data in source:
+            if not api_data:
+                continue
 
-        if api_data:
-            data = []
-            for item in api_data:
-                data.append(self.xeroapi.field_list(item, fields, date_fields))
+            data = self.xeroapi.rows(plan, api_data, prefix=prefix)
+            await self.archive_items("xero", endpoint, api_data, [id_field], tenant)
 
-            if data:
-                await asyncio.to_thread(self.db.write_data, data, table, fields, i_query, m_query)
+            await asyncio.to_thread(writer.write, data)
 
-            if nested:
-                if days is not None:
-                    ids = []
-                    for item in api_data:
-                        ids.append(item.get(id_field))
+            if use_watermark:
+                high = self.high_water(high, api_data, watermark or "UpdatedDateUTC")
 
-                for value in nested:
-                    nest = value.get("nest")
-                    fields = value.get("fields")
-                    date_fields = value.get("date_fields", [])
-                    table = f"xero_{endpoint}_{nest}"
-                    parent = fields[0]
+            if keyed:
+                ids = []
+                for item in api_data:
+                    ids.append(item.get(id_field))
+            else:
+                ids = None
 
-                    i_query = self.db.upsert(table, fields, schema="dbo")
+            for nest, nest_plan, nest_writer in children:
+                data = []
+                for item in api_data:
+                    data.extend(self.xeroapi.rows(nest_plan, item.get(nest, []), item.get(id_field), prefix))
 
-                    data = []
-                    for item in api_data:
-                        parent_id = item.get(id_field)
-                        nested_items = item.get(nest, [])
+                if data or ids:
+                    await asyncio.to_thread(nest_writer.write, data, ids)
 
-                        for nested_item in nested_items:
-                            data.append(self.xeroapi.field_list(nested_item, fields, date_fields, parent=parent, parent_id=parent_id))
-                    
-                    if data:
-                        if days is not None:
-                            await asyncio.to_thread(self.db.write_data, data, table, fields, i_query, id_field=parent, ids=ids)
-                        else:
-                            await asyncio.to_thread(self.db.write_data, data, table, fields, i_query)
+        writer.report()
+        written = self.written(watermark_key, [writer] + [nest_writer for nest, nest_plan, nest_writer in children], unit)
+        if written:
+            await self.save_watermark("xero", watermark_key, high)
+        if digest and written:
+            await asyncio.to_thread(self.db.set_fingerprint, "xero", watermark_key, digest, checked)
 
 class Update:
     def __init__(self, process: Process):
         self.process = process
+        self.xero_access = None
+
+    async def start(self):
+        asyncio.get_running_loop().set_default_executor(concurrent.futures.ThreadPoolExecutor(self.process.db.pool.size))
+        await asyncio.to_thread(self.process.db.setup)
+
+    async def export(self):
+        try:
+            await asyncio.to_thread(self.process.db.metrics.export, self.process.db)
+        except Exception as e:
+            print(f"Metrics error: {e}")
 
-    def backup(self):
+    async def close(self):
+        await self.process.cin7coreapi.http.close()
+        await self.process.xeroapi.http.close()
+        await asyncio.to_thread(self.process.close)
+
+    async def run(self, update):
+        self.process.db.metrics.reset()
+        try:
+            await self.start()
+            await update
+        finally:
+            await self.export()
+            await self.close()
+
+    async def backup(self):
+        tables = []
         for cfg in self.process.cin7coreapi.config:
-            self.process.backup_func(cfg, "cin7core")
+            tables += self.process.backup_tables(cfg, "cin7core")
 
         for cfg in self.process.xeroapi.config:
-            self.process.backup_func(cfg, "xero")
+            tables += self.process.backup_tables(cfg, "xero")
+
+        semaphore = asyncio.Semaphore(max(1, min(self.process.db.backup_workers, self.process.db.pool.size)))
+
+        async def task(table):
+            async with semaphore:
+                await asyncio.to_thread(self.process.db.backup, table)
+
+        await asyncio.gather(*[task(table) for table in tables])
 
         print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} - Backup completed")
 
-    async def update_cin7core(self, days=None):
-        config = self.process.cin7coreapi.config
+    async def dependencies(self, config, api):
+        owners = {}
+        for idx, cfg in enumerate(config):
+            for table in self.process.tables(cfg, api):
+                owners[table.lower()] = idx
+
+        deps = {idx: set() for idx in range(len(config))}
+        for child, parent in await asyncio.to_thread(self.process.db.foreign_keys):
+            child_idx = owners.get(child.lower())
+            parent_idx = owners.get(parent.lower())
+            if child_idx is not None and parent_idx is not None and parent_idx != child_idx:
+                deps[child_idx].add(parent_idx)
+
+        endpoints = {cfg.get("endpoint"): idx for idx, cfg in enumerate(config)}
+        for idx, cfg in enumerate(config):
+            for endpoint in cfg.get("depends_on", []):
+                if endpoints.get(endpoint, idx) != idx:
+                    deps[idx].add(endpoints[endpoint])
+
+        remaining = {idx: set(parents) for idx, parents in deps.items()}
+        while remaining:
+            ready = [idx for idx, parents in remaining.items() if not parents & remaining.keys()]
+            if not ready:
+                # Break the cycle at its entry that comes first in the config, which then runs before the entry it waited on.
+                path = [min(remaining)]
+                while path.count(path[-1]) < 2:
+                    path.append(min(remaining[path[-1]] & remaining.keys()))
+                cycle = path[path.index(path[-1]):-1]
+                idx = min(cycle)
+                parent = cycle[(cycle.index(idx) + 1) % len(cycle)]
+                deps[idx].discard(parent)
+                remaining[idx].discard(parent)
+                print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} - WARNING: Circular foreign keys or depends_on in {api} config: {[config[i].get('endpoint') for i in cycle]}, {config[idx].get('endpoint')} runs before {config[parent].get('endpoint')}")
+                continue
+            for idx in ready:
+                del remaining[idx]
+
+        return deps
+
+    async def schedule(self, config, api, run):
+        deps = await self.dependencies(config, api)
+        done = {idx: asyncio.Event() for idx in deps}
+        semaphore = asyncio.Semaphore(self.process.entry_workers)
+
+        async def task(idx):
+            try:
+                for parent in deps[idx]:
+                    await done[parent].wait()
+                async with semaphore:
+                    await run(config[idx])
+            finally:
+                done[idx].set()
+
+        await asyncio.gather(*[task(idx) for idx in deps])
+
+    @staticmethod
+    def select(config, endpoints=None):
+        if endpoints is None:
+            return config
+        return [cfg for cfg in config if cfg.get("endpoint") in endpoints]
+
+    async def update_cin7core(self, days=None, endpoints=None):
+        config = self.select(self.process.cin7coreapi.config, endpoints)
 
         for cfg in config:
             self.process.truncate_staging(cfg, "cin7core")
-            self.process.constraints(cfg, "nocheck", "cin7core")
+            if self.process.nocheck:
+                self.process.constraints(cfg, "nocheck", "cin7core")
             
-        tasks = [asyncio.create_task(self.process.cin7core(cfg, days)) for cfg in config]
-        await asyncio.gather(*tasks)
+        await self.schedule(config, "cin7core", lambda cfg: self.process.cin7core(cfg, days))
+
+        if self.process.nocheck:
+            for cfg in config:
+                self.process.constraints(cfg, "check", "cin7core")
 
+    async def update_xero(self, days=None, endpoints=None):
+        config = self.select(self.process.xeroapi.config, endpoints)
         for cfg in config:
-            self.process.constraints(cfg, "check", "cin7core")
+            for table in self.process.tables(cfg, "xero"):
+                await asyncio.to_thread(self.process.db.tenant_column, table)
 
-    async def update_xero(self, days=None):
-        config = self.process.xeroapi.config
-        token, tenant = self.process.xeroapi.access()
+        tenants = await self.save_access()
+        if not tenants:
+            return
 
         if days is not None:
             start_date = (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=days)).replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None).isoformat()
@@ -663,16 +2071,24 @@ class Update:
             start_date = None
 
         for cfg in config:
-            self.process.constraints(cfg, "nocheck", "xero")
+            if self.process.nocheck:
+                self.process.constraints(cfg, "nocheck", "xero")
             self.process.truncate_staging(cfg, "xero")
 
-        self.process.db.gen_query("TRUNCATE TABLE xeroAccess; INSERT INTO xeroAccess (Token, Tenant_ID) VALUES (?, ?);", (token, tenant))
+        await asyncio.gather(*[self.schedule(config, "xero", lambda cfg, tenant=tenant: self.process.xero(cfg, tenant, days, start_date)) for tenant in tenants])
+        await self.save_access()
 
-        tasks = [asyncio.create_task(self.process.xero(cfg, token, tenant, days, start_date)) for cfg in config]
-        await asyncio.gather(*tasks)
+        if self.process.nocheck:
+            for cfg in config:
+                self.process.constraints(cfg, "check", "xero")
 
-        for cfg in config:
-            self.process.constraints(cfg, "check", "xero")
+    async def save_access(self):
+        token, tenants = await self.process.xeroapi.access()
+        if token and token != self.xero_access:
+            await asyncio.to_thread(self.process.db.gen_query, "TRUNCATE TABLE xeroAccess;")
+            await asyncio.to_thread(self.process.db.executemany, "INSERT INTO xeroAccess (Token, Tenant_ID) VALUES (?, ?);", [(token, tenant) for tenant in tenants])
+            self.xero_access = token
+        return tenants
 
     async def update_all(self, days=None):
         start_time = time.time()
@@ -685,9 +2101,437 @@ class Update:
 
         print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} - Data update completed in {time.strftime('%Hh %Mm %Ss', time.gmtime(time.time() - start_time))}")
 
+class WorkQueue:
+    def __init__(self, update: Update):
+        with open("config.json", "r") as f:
+            config = json.load(f)
+
+        queue = config.get("Queue", {})
+        self.update = update
+        self.process = update.process
+        self.db = update.process.db
+        self.lease = queue.get("lease", 300)
+        self.unit_pages = queue.get("pages", 10)
+        self.unit_ids = queue.get("ids", 500)
+        self.poll = queue.get("poll", 5)
+        self.max_attempts = queue.get("max_attempts", 3)
+        self.workers = queue.get("workers", 1)
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+
+    def configs(self, api):
+        return self.process.cin7coreapi.config if api == "cin7core" else self.process.xeroapi.config
+
+    @staticmethod
+    def stages(deps):
+        stages = {}
+        while len(stages) < len(deps):
+            for idx, parents in deps.items():
+                if idx not in stages and all(parent in stages for parent in parents):
+                    stages[idx] = max([stages[parent] + 1 for parent in parents], default=0)
+        return stages
+
+    @staticmethod
+    def clear_tables(cfg):
+        return [value["table"] for value in cfg.get("nested", []) if value.get("table")]
+
+    @staticmethod
+    def reloads(cfg):
+        return bool(cfg.get("table")) and not cfg.get("staging")
+
+    def insert(self, run_id, api, endpoint, stage, days, payloads):
+        if payloads:
+            self.db.executemany(
+                "INSERT INTO sync_queue (RunID, Api, Endpoint, Stage, Days, Payload) VALUES (?, ?, ?, ?, ?, ?);",
+                [(run_id, api, endpoint, stage, days, json.dumps(payload)) for payload in payloads]
+            )
+
+    async def plan_cin7core(self, run_id, days):
+        config = self.process.cin7coreapi.config
+        stages = self.stages(await self.update.dependencies(config, "cin7core"))
+        highs = {}
+
+        for cfg in config:
+            await asyncio.to_thread(self.process.truncate_staging, cfg, "cin7core")
+            if days is None:
+                for table in self.clear_tables(cfg):
+                    await asyncio.to_thread(self.db.gen_query, f"DELETE FROM {table};")
+
+        async def plan(idx, cfg):
+            async def enqueue(pages=None, ids=None, high=None, start_date=None):
+                if ids is not None:
+                    payloads = [{"ids": ids[i:i + self.unit_ids], "start_date": start_date} for i in range(0, len(ids), self.unit_ids)]
+                else:
+                    # Tables reloaded without staging are deleted by the unit itself, so they are one unit covering every page.
+                    size = max(1, pages) if self.reloads(cfg) else self.unit_pages
+                    payloads = [{"first": first, "last": min(pages, first + size - 1), "start_date": start_date} for first in range(1, pages + 1, size)]
+                highs[cfg.get("endpoint")] = high
+                await asyncio.to_thread(self.insert, run_id, "cin7core", cfg.get("endpoint"), stages[idx], days, payloads)
+
+            await self.process.cin7core(cfg, days, enqueue=enqueue)
+
+        semaphore = asyncio.Semaphore(self.process.entry_workers)
+
+        async def task(idx, cfg):
+            async with semaphore:
+                await plan(idx, cfg)
+
+        await asyncio.gather(*[task(idx, cfg) for idx, cfg in enumerate(config)])
+        return highs
+
+    async def plan_xero(self, run_id, days):
+        config = self.process.xeroapi.config
+        stages = self.stages(await self.update.dependencies(config, "xero"))
+        for cfg in config:
+            for table in self.process.tables(cfg, "xero"):
+                await asyncio.to_thread(self.db.tenant_column, table)
+        tenants = await self.update.save_access()
+
+        if days is not None:
+            start_date = (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=days)).replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None).isoformat()
+        else:
+            start_date = None
+
+        for idx, cfg in enumerate(config):
+            await asyncio.to_thread(self.process.truncate_staging, cfg, "xero")
+            await asyncio.to_thread(self.insert, run_id, "xero", cfg.get("endpoint"), stages[idx], days, [{"tenant": tenant, "start_date": start_date} for tenant in tenants])
+
+    async def coordinate(self, days=None, api="all"):
+        run_id = str(uuid.uuid4())
+        start_time = time.time()
+        print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} - Queueing run {run_id}..")
+
+        highs = {}
+        if api in ("cin7core", "all"):
+            highs = await self.plan_cin7core(run_id, days)
+        if api in ("xero", "all"):
+            await self.plan_xero(run_id, days)
+
+        last = None
+        while True:
+            rows = await asyncio.to_thread(self.db.fetch_query, "SELECT Status, COUNT(*) FROM sync_queue WHERE RunID = ? GROUP BY Status;", (run_id,))
+            counts = {status: count for status, count in rows}
+            if counts != last:
+                print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} - Run {run_id}: " + ", ".join(f"{count} {status}" for status, count in sorted(counts.items())))
+                last = counts
+            if not counts.get("pending") and not counts.get("leased"):
+                break
+            await asyncio.sleep(self.poll)
+
+        rows = await asyncio.to_thread(self.db.fetch_query, """
+            SELECT Endpoint, MAX(Watermark), SUM(CASE WHEN Status = 'failed' THEN 1 ELSE 0 END)
+            FROM sync_queue
+            WHERE RunID = ? AND Api = 'cin7core'
+            GROUP BY Endpoint;
+        """, (run_id,))
+        for endpoint, high, failed in rows:
+            if failed:
+                print(f"{endpoint}: {failed} failed units, watermark not advanced")
+                continue
+            if highs.get(endpoint) and (high is None or highs[endpoint] > high):
+                high = highs[endpoint]
+            await self.process.save_watermark("cin7core", endpoint, high)
+
+        print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} - Run {run_id} completed in {time.strftime('%Hh %Mm %Ss', time.gmtime(time.time() - start_time))}")
+
+    def claim(self):
+        self.db.gen_query("""
+            UPDATE sync_queue SET Status = 'failed', Error = COALESCE(Error, 'Lease expired')
+            WHERE Status = 'leased' AND LeaseUntil < SYSUTCDATETIME() AND Attempts >= ?;
+        """, (self.max_attempts,))
+
+        rows = self.db.fetch_query("""
+            WITH next AS (
+                SELECT TOP (1) *
+                FROM sync_queue AS q WITH (ROWLOCK, UPDLOCK, READPAST)
+                WHERE (q.Status = 'pending' OR (q.Status = 'leased' AND q.LeaseUntil < SYSUTCDATETIME()))
+                    AND NOT EXISTS (
+                        SELECT 1 FROM sync_queue AS p
+                        WHERE p.RunID = q.RunID AND p.Api = q.Api AND p.Stage < q.Stage AND p.Status NOT IN ('done', 'failed')
+                    )
+                ORDER BY q.UnitID
+            )
+            UPDATE next
+            SET Status = 'leased', Worker = ?, LeaseUntil = DATEADD(SECOND, ?, SYSUTCDATETIME()), Attempts = Attempts + 1
+            OUTPUT inserted.UnitID, inserted.Api, inserted.Endpoint, inserted.Days, inserted.Payload;
+        """, (self.worker, self.lease), commit=True)
+        return rows[0] if rows else None
+
+    def renew(self, unit_id):
+        self.db.gen_query("UPDATE sync_queue SET LeaseUntil = DATEADD(SECOND, ?, SYSUTCDATETIME()) WHERE UnitID = ? AND Worker = ? AND Status = 'leased';", (self.lease, unit_id, self.worker))
+
+    def ack(self, unit_id, high):
+        self.db.gen_query("UPDATE sync_queue SET Status = 'done', Watermark = ?, Finished = SYSUTCDATETIME(), LeaseUntil = NULL WHERE UnitID = ? AND Worker = ?;", (high, unit_id, self.worker))
+
+    def fail(self, unit_id, error):
+        self.db.gen_query("""
+            UPDATE sync_queue SET Status = CASE WHEN Attempts >= ? THEN 'failed' ELSE 'pending' END, Error = ?, LeaseUntil = NULL
+            WHERE UnitID = ? AND Worker = ?;
+        """, (self.max_attempts, error, unit_id, self.worker))
+
+    async def heartbeat(self, unit_id):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                await asyncio.to_thread(self.renew, unit_id)
+            except Exception as e:
+                print(f"Lease renewal error: {e}")
+
+    async def execute(self, api, endpoint, days, payload):
+        cfg = next(cfg for cfg in self.configs(api) if cfg.get("endpoint") == endpoint)
+        if api == "cin7core":
+            return await self.process.cin7core(cfg, days, unit=payload)
+        await self.process.xero(cfg, payload["tenant"], days, payload.get("start_date"), unit=payload)
+        return None
+
+    async def work_loop(self, drain):
+        while True:
+            unit = await asyncio.to_thread(self.claim)
+            if unit is None:
+                if drain and not (await asyncio.to_thread(self.db.fetch_query, "SELECT COUNT(*) FROM sync_queue WHERE Status IN ('pending', 'leased');"))[0][0]:
+                    return
+                await asyncio.sleep(self.poll)
+                continue
+
+            unit_id, api, endpoint, days, payload = unit
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} - Unit {unit_id} {api}/{endpoint} started")
+            heartbeat = asyncio.create_task(self.heartbeat(unit_id))
+            try:
+                high = await self.execute(api, endpoint, days, json.loads(payload))
+                await asyncio.to_thread(self.ack, unit_id, high)
+                print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} - Unit {unit_id} {api}/{endpoint} done")
+            except Exception as e:
+                print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} - Unit {unit_id} {api}/{endpoint} error: {e}")
+                await asyncio.to_thread(self.fail, unit_id, str(e))
+            finally:
+                heartbeat.cancel()
+
+    async def work(self, drain=False):
+        print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} - Worker {self.worker} started")
+        await asyncio.gather(*[self.work_loop(drain) for _ in range(self.workers)])
+        print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} - Worker {self.worker} finished")
+
+class Cron:
+    ranges = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression):
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError(f"Cron expression needs 5 fields: {expression}")
+
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, weekdays = [self.parse(part, low, high) for part, (low, high) in zip(parts, self.ranges)]
+        self.weekdays = {day % 7 for day in weekdays}
+        self.any_day = parts[2] == "*"
+        self.any_weekday = parts[4] == "*"
+
+    @staticmethod
+    def parse(part, low, high):
+        values = set()
+        for item in part.split(","):
+            value, _, step = item.partition("/")
+            if value == "*":
+                first, last = low, high
+            elif "-" in value:
+                first, last = (int(v) for v in value.split("-"))
+            else:
+                first = last = int(value)
+                if step:
+                    last = high
+
+            if first < low or last > high or first > last:
+                raise ValueError(f"Cron field out of range: {part}")
+            values.update(range(first, last + 1, int(step) if step else 1))
+        return values
+
+    def day_matches(self, moment):
+        day = moment.day in self.days
+        weekday = (moment.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next(self, after):
+        moment = after.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = moment + datetime.timedelta(days=366 * 4)
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+            elif not self.day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + datetime.timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += datetime.timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError(f"Cron expression never matches: {self.expression}")
+
+class Service:
+    def __init__(self, update: Update, schedules=None, days=0):
+        with open("config.json", "r") as f:
+            config = json.load(f)
+
+        service = config.get("Service", {})
+        self.update = update
+        self.days = days if days is not None else service.get("days", 0)
+        self.jobs = [self.job(schedule) for schedule in (schedules or service.get("schedules", []))]
+        self.locks = collections.defaultdict(asyncio.Lock)
+        self.active = 0
+
+        if not self.jobs:
+            raise ValueError("No schedules configured")
+
+    def job(self, schedule):
+        api = schedule.get("api", "all")
+        if schedule.get("task") != "backup" and api not in ("cin7core", "xero", "all"):
+            raise ValueError(f"Unknown api in schedule: {api}")
+
+        return {
+            "name": schedule.get("name") or f"{schedule.get('task') or api}:{','.join(schedule.get('endpoints') or ['*'])}",
+            "cron": Cron(schedule["cron"]),
+            "task": schedule.get("task", "update"),
+            "api": api,
+            "endpoints": schedule.get("endpoints"),
+            "days": schedule.get("days", self.days)
+        }
+
+    @staticmethod
+    def parse(cron, target):
+        if target == "backup":
+            return {"cron": cron, "task": "backup"}
+
+        api, _, endpoints = target.partition(":")
+        return {"cron": cron, "api": api, "endpoints": endpoints.split(",") if endpoints else None}
+
+    def keys(self, job):
+        process = self.update.process
+        apis = {"cin7core": process.cin7coreapi.config, "xero": process.xeroapi.config}
+
+        keys = []
+        for api, config in apis.items():
+            if job["task"] == "backup" or job["api"] in (api, "all"):
+                keys.extend((api, cfg.get("endpoint")) for cfg in self.update.select(config, job["endpoints"]))
+        return sorted(keys)
+
+    async def execute(self, job):
+        update = self.update
+        if job["task"] == "backup":
+            await update.backup()
+        elif job["api"] == "cin7core":
+            await update.update_cin7core(job["days"], job["endpoints"])
+        elif job["api"] == "xero":
+            await update.update_xero(job["days"], job["endpoints"])
+        else:
+            await asyncio.gather(update.update_cin7core(job["days"], job["endpoints"]), update.update_xero(job["days"], job["endpoints"]))
+
+    async def run_job(self, job):
+        async with contextlib.AsyncExitStack() as stack:
+            for key in self.keys(job):
+                await stack.enter_async_context(self.locks[key])
+
+            if self.active == 0:
+                self.update.process.db.metrics.reset()
+            self.active += 1
+
+            start_time = time.time()
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} - {job['name']} started")
+            try:
+                await self.execute(job)
+                print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} - {job['name']} completed in {time.strftime('%Hh %Mm %Ss', time.gmtime(time.time() - start_time))}")
+            except Exception as e:
+                print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} - {job['name']} error: {e}")
+            finally:
+                self.active -= 1
+                if self.active == 0:
+                    await self.update.export()
+
+    async def sleep_until(self, moment, stop):
+        while not stop.is_set():
+            remaining = (moment - datetime.datetime.now()).total_seconds()
+            if remaining <= 0:
+                return
+            try:
+                await asyncio.wait_for(stop.wait(), min(remaining, 60))
+            except asyncio.TimeoutError:
+                continue
+
+    async def loop(self, job, stop):
+        due = job["cron"].next(datetime.datetime.now())
+        while not stop.is_set():
+            await self.sleep_until(due, stop)
+            if stop.is_set():
+                break
+
+            await self.run_job(job)
+
+            due = job["cron"].next(due)
+            now = datetime.datetime.now()
+            if due <= now:
+                print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} - {job['name']} overran its schedule, skipping to the next slot")
+                due = job["cron"].next(now)
+
+    async def run(self):
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+        await self.update.start()
+        print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} - Service started with {len(self.jobs)} schedules")
+        for job in self.jobs:
+            print(f"{job['name']}: {job['cron'].expression}, next run {job['cron'].next(datetime.datetime.now())}")
+
+        try:
+            await asyncio.gather(*[self.loop(job, stop) for job in self.jobs])
+        finally:
+            await self.update.close()
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} - Service stopped")
+
 if __name__ == "__main__":
 
-    update = Update(Process(db=Database(), cin7core=Cin7CoreApi(), xero=XeroApi()))
+    parser = argparse.ArgumentParser(description="Sync Cin7Core and Xero data to the database.")
+    parser.add_argument("--service", action="store_true", help="run headless using the schedules in config.json Service.schedules")
+    parser.add_argument("--schedule", nargs=2, action="append", metavar=("CRON", "TARGET"), help="add a schedule, e.g. \"*/5 * * * *\" cin7core:ref/productavailability or \"0 2 * * *\" backup")
+    parser.add_argument("--days", type=int, help="days to update for scheduled or queued runs (default Service.days or 0; queued runs are full without it)")
+    parser.add_argument("--coordinator", action="store_true", help="split a sync into work units in sync_queue and wait for workers to finish them")
+    parser.add_argument("--worker", action="store_true", help="claim and run work units from sync_queue")
+    parser.add_argument("--drain", action="store_true", help="with --worker, exit once the queue has no pending or leased units")
+    parser.add_argument("--rebuild", action="store_true", help="reload the tables from the raw response archive without any API calls")
+    parser.add_argument("--api", choices=["cin7core", "xero", "all"], default="all", help="with --coordinator or --rebuild, which API to sync")
+    args = parser.parse_args()
+
+    http_client = HttpClient()
+    metrics = Metrics()
+    archive = Archive()
+
+    if args.rebuild:
+        archive.replay = True
+        update = Update(Process(db=Database(metrics), cin7core=ArchiveCin7CoreApi(archive, http_client, metrics), xero=ArchiveXeroApi(archive, http_client, metrics), archive=archive))
+        if args.api == "cin7core":
+            asyncio.run(update.run(update.update_cin7core(None)))
+        elif args.api == "xero":
+            asyncio.run(update.run(update.update_xero(None)))
+        else:
+            asyncio.run(update.run(update.update_all(None)))
+        sys.exit(0)
+
+    update = Update(Process(db=Database(metrics), cin7core=Cin7CoreApi(http_client, metrics), xero=XeroApi(http_client, metrics), archive=archive if archive.enabled else None))
+
+    if args.coordinator:
+        asyncio.run(update.run(WorkQueue(update).coordinate(args.days, args.api)))
+        sys.exit(0)
+
+    if args.worker:
+        asyncio.run(update.run(WorkQueue(update).work(args.drain)))
+        sys.exit(0)
+
+    if args.service or args.schedule:
+        schedules = [Service.parse(cron, target) for cron, target in args.schedule] if args.schedule else None
+        asyncio.run(Service(update, schedules, args.days).run())
+        sys.exit(0)
 
     while True:
         try: 
@@ -712,14 +2556,14 @@ if __name__ == "__main__":
                 while True:
                     if datetime.datetime.now().weekday() < 5 and 6 <= datetime.datetime.now().hour < 18:
                         try:
-                            asyncio.run(update.update_all(days))
+                            asyncio.run(update.run(update.update_all(days)))
                             backup_count = 0
                         except Exception as e:
                             print(f"Error: {e}")    
                         time.sleep(interval)
                     elif (datetime.datetime.now().hour >= 18 or datetime.datetime.now().hour < 6) and backup_count == 0:
                         try:
-                            update.backup()
+                            asyncio.run(update.run(update.backup()))
                             backup_count += 1
                         except Exception as e:
                             print(f"Error: {e}")    
@@ -740,12 +2584,12 @@ if __name__ == "__main__":
                             start_time = time.time()
                             print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} - Updating database..")
                             if api == "C":
-                                asyncio.run(update.update_cin7core(days))
+                                asyncio.run(update.run(update.update_cin7core(days)))
                             else:
-                                asyncio.run(update.update_xero(days))
+                                asyncio.run(update.run(update.update_xero(days)))
                             print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} - Data update completed in {time.strftime('%Hh %Mm %Ss', time.gmtime(time.time() - start_time))}")
                         elif api == "B":
-                            asyncio.run(update.update_all(days))
+                            asyncio.run(update.run(update.update_all(days)))
                         else:
                             raise ValueError
                         break
@@ -0,0 +1,526 @@
+# Offline benchmark for apiSync.py.
+# Replays recorded or synthetic Cin7Core / Xero responses through a local HTTP stub (configurable latency and 429 injection)
+# and runs the real Process.cin7core / Process.xero code paths against them, so changes to Process, Writer or Database can be compared against a fixed workload.
+# Synthetic responses are generated from Cin7Core_API.json and Xero_API.json, including per-record responses for the Cin7Core record endpoints (endpoint_id).
+# Recorded responses are read from a fixtures directory laid out as <dir>/cin7core/<endpoint>.json and <dir>/xero/<endpoint>.json,
+# each a JSON list of items (records for record endpoints, "/" in endpoints becomes "_").
+# Rows are written through an in-memory SQLite stand-in for Database by default, or with --db to a SQL Server scratch database
+# (e.g. a local container) that already holds the apiSync schema. Its tables are overwritten.
+# Each endpoint is timed end to end; flatten and write seconds come from the flatten_seconds and write_seconds metrics and the rest is fetching.
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import math
+import os
+import random
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+import http.server
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import apiSync
+
+def fixture_name(endpoint):
+    return endpoint.replace("/", "_") + ".json"
+
+class Fixtures:
+    def __init__(self, rows=5000, children=3, seed=0, path=None):
+        self.rows = rows
+        self.children = children
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.path = path
+
+    def value(self, api, field, date=False, rng=None):
+        rng = rng or self.rng
+        if date:
+            day = datetime.datetime(2024, 1, 1) + datetime.timedelta(minutes=rng.randrange(0, 525600))
+            if api == "xero":
+                return f"/Date({int(day.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000)}+0000)/"
+            return day.isoformat()
+        if field.endswith("ID"):
+            return str(uuid.UUID(int=rng.getrandbits(128)))
+        kind = rng.randrange(4)
+        if kind == 0:
+            return round(rng.uniform(0, 10000), 2)
+        if kind == 1:
+            return rng.choice([True, False])
+        return "".join(rng.choice("abcdefghijklmnopqrstuvwxyz ") for _ in range(rng.randrange(4, 40)))
+
+    def item(self, api, fields, date_fields=(), parent=None, parent_id=None):
+        item = {}
+        for field in fields:
+            value = parent_id if field == parent else self.value(api, field, field in date_fields)
+            if api == "xero" and "_" in field:
+                node = item
+                path = field.split("_")
+                for part in path[:-1]:
+                    node = node.setdefault(part, {})
+                node[path[-1]] = value
+            else:
+                item[field] = value
+        return item
+
+    def items(self, api, cfg):
+        if self.path:
+            with open(os.path.join(self.path, api, fixture_name(cfg["endpoint"])), "r") as f:
+                return json.load(f)
+
+        fields = cfg["fields"]
+        items = []
+        for _ in range(self.rows):
+            item = self.item(api, fields, cfg.get("date_fields", []))
+            for value in cfg.get("nested", []):
+                item[value["nest"]] = [
+                    self.item(api, value["fields"], value.get("date_fields", []), value["fields"][0], item.get(fields[0]))
+                    for _ in range(self.children)
+                ]
+            items.append(item)
+        return items
+
+    def fill(self, item, fields, date_fields, rng):
+        for field in fields:
+            item.setdefault(field, self.value("cin7core", field, field in date_fields, rng))
+
+    def record(self, cfg, id):
+        rng = random.Random(f"{self.seed}:{id}")
+        record = {cfg["id_field"]: id}
+        for value in cfg["nested"]:
+            date_fields = set(value.get("date_fields", []))
+            fields2 = value.get("nest2_fields", [])
+            fields3 = value.get("nest3_fields", [])
+            fields = [field for field in value["fields"][1:] if field not in fields2 and field not in fields3]
+
+            for item in record.setdefault(value["nest"], [{} for _ in range(self.children)]):
+                self.fill(item, fields, date_fields, rng)
+                if not value.get("nest2"):
+                    continue
+                for item2 in item.setdefault(value["nest2"], [{} for _ in range(self.children)]):
+                    self.fill(item2, fields2, date_fields, rng)
+                    if not value.get("nest3"):
+                        continue
+                    for item3 in item2.setdefault(value["nest3"], [{} for _ in range(self.children)]):
+                        self.fill(item3, fields3, date_fields, rng)
+        return record
+
+    def records(self, cfg, ids):
+        if self.path:
+            with open(os.path.join(self.path, "cin7core", fixture_name(cfg["endpoint"])), "r") as f:
+                return {str(record.get(cfg["id_field"])): record for record in json.load(f)}
+        return {id: self.record(cfg, id) for id in ids if id is not None}
+
+    def save(self, path, api, cfg, items):
+        os.makedirs(os.path.join(path, api), exist_ok=True)
+        with open(os.path.join(path, api, fixture_name(cfg["endpoint"])), "w") as f:
+            json.dump(items, f)
+
+class Stub:
+    def __init__(self, latency=0.05, error_rate=0.0, retry_after=1, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.routes = {}
+        self.requests = 0
+        self.errors = 0
+
+    def add(self, api, cfg, items):
+        self.routes[f"/{api}/{cfg['endpoint']}"] = (api, cfg, items)
+
+    def add_records(self, cfg, records):
+        self.routes[f"/cin7core/{cfg['endpoint']}"] = ("record", cfg, records)
+
+    def respond(self, path, query):
+        if path == "/token":
+            return {"access_token": "bench", "expires_in": 1800}
+        if path == "/connections":
+            return [{"tenantId": "bench"}]
+
+        api, cfg, items = self.routes[path]
+        if api == "record":
+            return items[query[cfg["id_field"]]]
+
+        if api == "cin7core":
+            page = int(query.get("Page", 1))
+            limit = int(query.get("Limit", 1000))
+            return {"Total": len(items), cfg["list_field"]: items[(page - 1) * limit:page * limit]}
+
+        if not cfg.get("paged"):
+            return {cfg["endpoint"]: items}
+        page = int(query.get("page", 1))
+        size = int(query.get("pageSize", 1000))
+        return {cfg["endpoint"]: items[(page - 1) * size:page * size], "pagination": {"pageCount": math.ceil(len(items) / size)}}
+
+    def start(self):
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                self.do_GET()
+
+            def do_GET(self):
+                url = urllib.parse.urlsplit(self.path)
+                query = dict(urllib.parse.parse_qsl(url.query))
+                time.sleep(stub.latency)
+
+                with stub.lock:
+                    stub.requests += 1
+                    throttle = stub.rng.random() < stub.error_rate
+                    if throttle:
+                        stub.errors += 1
+
+                if throttle:
+                    self.send_response(429)
+                    self.send_header("Retry-After", str(stub.retry_after))
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+                try:
+                    body = json.dumps(stub.respond(urllib.parse.unquote(url.path), query)).encode()
+                except KeyError:
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class SqliteCursor:
+    # Stands in for a pyodbc cursor: the SQL Server statements Writer issues are rewritten for SQLite so Writer.load runs unchanged.
+    rules = (
+        (r"^\s*EXEC sp_(getapplock|releaseapplock)\b.*$", ""),
+        (r"TRUNCATE TABLE", "DELETE FROM"),
+        (r"IF OBJECT_ID\('tempdb\.\.#(\w+)'\) IS NOT NULL DROP TABLE #\w+;", r"DROP TABLE IF EXISTS temp.\1;"),
+        (r"SELECT TOP 0 \w+ AS id INTO #(\w+) FROM \S+;", r"CREATE TEMP TABLE \1 (id);"),
+        (r"DELETE t FROM (\S+) AS t INNER JOIN #(\w+) AS k ON t\.(\w+) = k\.id WHERE t\.(\w+) = \?;", r"DELETE FROM \1 WHERE \3 IN (SELECT id FROM temp.\2) AND \4 = ?;"),
+        (r"DELETE t FROM (\S+) AS t INNER JOIN #(\w+) AS k ON t\.(\w+) = k\.id;", r"DELETE FROM \1 WHERE \3 IN (SELECT id FROM temp.\2);"),
+        (r"#(\w+)", r"temp.\1"),
+    )
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.cursor = connection.conn.cursor()
+        self.fast_executemany = False
+        self.result = None
+
+    def translate(self, query):
+        for pattern, replacement in self.rules:
+            query = re.sub(pattern, replacement, query, flags=re.M)
+        return query.strip()
+
+    def execute(self, query, params=()):
+        self.result = None
+        merge = re.search(r"MERGE dbo\.(\w+) AS t\s+USING staging\.\w+ AS s\s+ON (.+?)\s+WHEN", query, re.S)
+        if merge:
+            self.result = self.merge(merge.group(1), re.findall(r"t\.(\w+) = s\.\w+", merge.group(2)))
+            return self
+        query = self.translate(query)
+        if query:
+            self.cursor.execute(query, params)
+        return self
+
+    def executemany(self, query, rows):
+        self.cursor.executemany(self.translate(query), rows)
+
+    def merge(self, table, keys):
+        cursor = self.cursor
+        fields = [row[1] for row in cursor.execute(f"PRAGMA staging.table_info({table});").fetchall()]
+        matched = " AND ".join(f"d.{key} = s.{key}" for key in keys)
+        same = " AND ".join(f"d.{field} IS s.{field}" for field in fields)
+        staged = cursor.execute(f"SELECT COUNT(*) FROM staging.{table};").fetchone()[0]
+        existing = cursor.execute(f"SELECT COUNT(*) FROM staging.{table} s WHERE EXISTS (SELECT 1 FROM dbo.{table} d WHERE {matched});").fetchone()[0]
+        unchanged = cursor.execute(f"SELECT COUNT(*) FROM staging.{table} s WHERE EXISTS (SELECT 1 FROM dbo.{table} d WHERE {same});").fetchone()[0]
+        cursor.execute(f"DELETE FROM dbo.{table} WHERE ({', '.join(keys)}) IN (SELECT {', '.join(keys)} FROM staging.{table});")
+        cursor.execute(f"INSERT INTO dbo.{table} ({', '.join(fields)}) SELECT {', '.join(fields)} FROM staging.{table};")
+        return (staged, staged - existing, existing - unchanged)
+
+    def fetchone(self):
+        return self.result if self.result is not None else self.cursor.fetchone()
+
+    def fetchall(self):
+        return [self.result] if self.result is not None else self.cursor.fetchall()
+
+class SqliteConnection:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def cursor(self):
+        return SqliteCursor(self)
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+class SqlitePool:
+    # One shared in-memory connection, handed to one writer at a time like a pool of size 1.
+    def __init__(self, conn, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.shared = SqliteConnection(conn)
+
+    @contextlib.contextmanager
+    def connection(self):
+        with self.lock:
+            yield self.shared
+
+    def run(self, fn):
+        with self.connection() as connection:
+            return fn(connection)
+
+    def close(self):
+        pass
+
+class SqliteDatabase(apiSync.Database):
+    def __init__(self, metrics):
+        sqlite3.register_adapter(datetime.date, datetime.date.isoformat)
+        self.metrics = metrics
+        self.conn = sqlite3.connect(":memory:", check_same_thread=False)
+        self.conn.execute("ATTACH DATABASE ':memory:' AS dbo;")
+        self.conn.execute("ATTACH DATABASE ':memory:' AS staging;")
+        self.pool = SqlitePool(self.conn, os.cpu_count() or 4)
+        self.bcp = None
+        self.columns = {}
+        self.widths = {}
+        self.tenant_tables = set()
+        self.tables = set()
+        self.watermarks = {}
+        self.fingerprints = {}
+
+    def setup(self):
+        pass
+
+    def create(self, table, fields, staging=False):
+        with self.pool.connection():
+            for schema in ("dbo", "staging") if staging else ("dbo",):
+                if (schema, table) not in self.tables:
+                    self.conn.execute(f"CREATE TABLE {schema}.{table} ({', '.join(fields)});")
+                    self.tables.add((schema, table))
+
+    def writer(self, table, fields, i_query, m_query=None, id_field=None, bulk=False, scope=None):
+        self.create(table, fields, bool(m_query))
+        return super().writer(table, fields, i_query, m_query, id_field, False, scope)
+
+    def get_watermark(self, api, endpoint):
+        return self.watermarks.get((api, endpoint))
+
+    def set_watermark(self, api, endpoint, watermark):
+        self.watermarks[(api, endpoint)] = max(watermark, self.watermarks.get((api, endpoint), watermark))
+
+    def get_fingerprint(self, api, endpoint):
+        return self.fingerprints.get((api, endpoint))
+
+    def set_fingerprint(self, api, endpoint, fingerprint, checked):
+        self.fingerprints[(api, endpoint)] = (fingerprint, checked)
+
+    def foreign_keys(self):
+        return []
+
+    def tenant_column(self, table):
+        pass
+
+    def close(self):
+        self.conn.close()
+
+class Benchmark:
+    def __init__(self, args, stub):
+        self.args = args
+        self.stub = stub
+        self.metrics = apiSync.Metrics()
+        self.http = apiSync.HttpClient()
+        self.db = apiSync.Database(self.metrics) if args.db else SqliteDatabase(self.metrics)
+        self.process = apiSync.Process(self.db, apiSync.Cin7CoreApi(self.http, self.metrics), apiSync.XeroApi(self.http, self.metrics))
+        self.update = apiSync.Update(self.process)
+        self.results = []
+
+    def entries(self):
+        entries = []
+        if self.args.api in ("cin7core", "all"):
+            entries += [("cin7core", cfg) for cfg in self.process.cin7coreapi.config]
+        if self.args.api in ("xero", "all"):
+            entries += [("xero", cfg) for cfg in self.process.xeroapi.config]
+        if self.args.endpoints:
+            entries = [(api, cfg) for api, cfg in entries if cfg["endpoint"] in self.args.endpoints]
+        return [(api, cfg) for api, cfg in entries if f"/{api}/{cfg['endpoint']}" in self.stub.routes]
+
+    async def endpoint(self, api, cfg, run):
+        self.metrics.reset()
+        start = time.perf_counter()
+        if api == "cin7core":
+            await self.process.cin7core(cfg, None)
+        else:
+            token, tenants = await self.process.xeroapi.access()
+            await asyncio.gather(*[self.process.xero(cfg, tenant, None) for tenant in tenants])
+        seconds = time.perf_counter() - start
+
+        counters = {}
+        for run_id, started, metric_api, endpoint, table, metric, value in self.metrics.rows():
+            counters[metric] = counters.get(metric, 0) + value
+        self.results.append((run, f"{api}/{cfg['endpoint']}", seconds, counters))
+        print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} - Pass {run} {api}/{cfg['endpoint']}: {counters.get('rows_written', 0):.0f} rows in {seconds:.2f}s")
+
+    async def run(self):
+        try:
+            await self.update.start()
+            for run in range(1, self.args.passes + 1):
+                for api, cfg in self.entries():
+                    await self.endpoint(api, cfg, run)
+        finally:
+            await self.update.close()
+            self.db.pool.close()
+            if not self.args.db:
+                self.db.close()
+
+    def report(self):
+        def rate(count, seconds):
+            return f"{count / seconds:,.0f}/s" if seconds else "-"
+
+        def line(run, name, seconds, counters):
+            calls, rows, mib = counters.get("api_calls", 0), counters.get("rows_written", 0), counters.get("bytes_downloaded", 0) / 1048576
+            flatten, write = counters.get("flatten_seconds", 0), counters.get("write_seconds", 0)
+            fetch = max(seconds - flatten - write, 0)
+            print(f"{run:<6}{name:<42}{calls:>8.0f}{rows:>10.0f}{seconds:>10.2f}{f'{mib / fetch:,.1f} MiB/s' if fetch else '-':>14}{rate(counters.get('rows_flattened', 0), flatten):>14}{rate(rows, write):>14}")
+            return fetch, flatten, write
+
+        print(f"\n{'Pass':<6}{'Endpoint':<42}{'Calls':>8}{'Rows':>10}{'Seconds':>10}{'Fetch':>14}{'Flatten':>14}{'Write':>14}")
+        totals = {}
+        for run, name, seconds, counters in self.results:
+            line(run, name, seconds, counters)
+            totals["seconds"] = totals.get("seconds", 0) + seconds
+            for metric, value in counters.items():
+                totals[metric] = totals.get(metric, 0) + value
+
+        fetch, flatten, write = line("", "Total", totals.get("seconds", 0), totals)
+        print(f"Stage seconds: fetch {fetch:.2f}, flatten {flatten:.2f}, write {write:.2f} (merge {totals.get('merge_seconds', 0):.2f}, connection wait {totals.get('connection_wait_seconds', 0):.2f})")
+        print(f"Retries: {totals.get('retries', 0):.0f}, backoff: {totals.get('backoff_seconds', 0):.2f}s, downloaded: {totals.get('bytes_downloaded', 0) / 1048576:.1f} MiB, "
+              f"fingerprint skips: {totals.get('fingerprint_skips', 0):.0f}, write errors: {totals.get('write_errors', 0):.0f}, stub 429s: {self.stub.errors}")
+
+def arguments():
+    parser = argparse.ArgumentParser(description="Offline benchmark of apiSync.py Process / Database against a stub API")
+    parser.add_argument("--api", choices=["cin7core", "xero", "all"], default="all")
+    parser.add_argument("--endpoints", nargs="*", help="only benchmark these endpoints")
+    parser.add_argument("--rows", type=int, default=5000, help="synthetic items per endpoint (and records per record endpoint)")
+    parser.add_argument("--children", type=int, default=3, help="synthetic nested items per parent")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--fixtures", help="directory of recorded responses to replay instead of synthetic data")
+    parser.add_argument("--save", help="write the generated fixtures to this directory")
+    parser.add_argument("--latency", type=float, default=50, help="stub latency per request in milliseconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--retry-after", type=float, default=1, help="Retry-After seconds sent with injected 429s")
+    parser.add_argument("--concurrency", type=int, default=8, help="pages and records fetched concurrently")
+    parser.add_argument("--calls-per-minute", type=int, default=60000)
+    parser.add_argument("--flatten-workers", type=int, help="Sync.flatten_workers for record endpoints (0 = thread)")
+    parser.add_argument("--passes", type=int, default=1, help="run every endpoint this many times (later passes show fingerprint skips)")
+    parser.add_argument("--db", help="SQL Server ODBC connection string of a scratch database with the apiSync schema; defaults to an in-memory SQLite stand-in")
+    return parser.parse_args()
+
+def load_fixtures(args, stub, fixtures, save):
+    def selected(cfg):
+        return not args.endpoints or cfg["endpoint"] in args.endpoints
+
+    for api, name in (("cin7core", "Cin7Core_API.json"), ("xero", "Xero_API.json")):
+        with open(name, "r") as f:
+            config = json.load(f)
+
+        # Record endpoints read their IDs from a list endpoint, which is served even when it is not benchmarked itself.
+        lists = {cfg["endpoint_id"] for cfg in config if cfg.get("endpoint_id") and selected(cfg)}
+        for cfg in config:
+            if cfg.get("endpoint_id") or not (selected(cfg) or cfg["endpoint"] in lists):
+                continue
+            try:
+                items = fixtures.items(api, cfg)
+            except FileNotFoundError:
+                print(f"Skipping {api}/{cfg['endpoint']} (no fixture)")
+                continue
+            if save:
+                fixtures.save(save, api, cfg, items)
+            stub.add(api, cfg, items)
+
+        for cfg in config:
+            if not cfg.get("endpoint_id") or not selected(cfg):
+                continue
+            route = stub.routes.get(f"/cin7core/{cfg['endpoint_id']}")
+            if route is None:
+                print(f"Skipping {api}/{cfg['endpoint']} (no {cfg['endpoint_id']} fixture)")
+                continue
+            try:
+                records = fixtures.records(cfg, [item.get(cfg["list_id"]) for item in route[2]])
+            except FileNotFoundError:
+                print(f"Skipping {api}/{cfg['endpoint']} (no fixture)")
+                continue
+            if save:
+                fixtures.save(save, api, cfg, list(records.values()))
+            stub.add_records(cfg, records)
+
+if __name__ == "__main__":
+    args = arguments()
+    source = os.path.dirname(os.path.abspath(__file__))
+    fixtures = Fixtures(args.rows, args.children, args.seed, args.fixtures and os.path.abspath(args.fixtures))
+    save = args.save and os.path.abspath(args.save)
+    stub = Stub(args.latency / 1000, args.error_rate, args.retry_after, args.seed)
+    url = stub.start()
+
+    workdir = tempfile.mkdtemp(prefix="apisync_bench_")
+    try:
+        for name in ("Cin7Core_API.json", "Xero_API.json"):
+            shutil.copy(os.path.join(source, name), workdir)
+
+        limits = {"calls_per_minute": args.calls_per_minute, "max_concurrency": args.concurrency}
+        sync = {"page_concurrency": args.concurrency, "record_concurrency": args.concurrency, "checkpoint_dir": os.path.join(workdir, "checkpoints")}
+        if args.flatten_workers is not None:
+            sync["flatten_workers"] = args.flatten_workers
+        with open(os.path.join(workdir, "config.json"), "w") as f:
+            json.dump({
+                "Cin7CoreApi": {"url": f"{url}/cin7core/", "headers": {}, **limits},
+                "Xero": {"clientId": "", "clientSecret": "", "tokenUrl": f"{url}/token", "connUrl": f"{url}/connections", "url": f"{url}/xero/", **limits},
+                "Azure": args.db or "",
+                "Http": {"http2": False},
+                "Sync": sync
+            }, f)
+        os.chdir(workdir)
+
+        load_fixtures(args, stub, fixtures, save)
+
+        benchmark = Benchmark(args, stub)
+        start_time = time.time()
+        print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} - Benchmark started against {url}")
+        asyncio.run(benchmark.run())
+        benchmark.report()
+        print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} - Benchmark completed in {time.strftime('%Hh %Mm %Ss', time.gmtime(time.time() - start_time))}")
+    finally:
+        stub.stop()
+        os.chdir(source)
+        shutil.rmtree(workdir, ignore_errors=True)
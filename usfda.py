@@ -1,51 +1,157 @@
 # Quick script to pull data from the US Food and Drug Administration API.
 # Requested by the regulatory team because the USFDA website can only show up to 500 records in total.
-# Excel Power Query was used to parse the JSON files into tables. 
+# Excel Power Query was used to parse the JSON files into tables.
+# Product codes and pages are downloaded concurrently within the openFDA rate limit and streamed to one NDJSON file per code (gzip optional).
+# Completed pages are recorded in a state file so an interrupted download resumes where it stopped.
+# openFDA will not page past skip 25000, so date_received ranges with more records than that are split in half until they fit.
 
 import requests
-import time
+import concurrent.futures
+import datetime
+import gzip
 import json
+import os
+import threading
+import time
 
 url = "https://api.fda.gov/device/event.json"
 key = ""
 
 codes = ["hwc", "hsb", "jds", "ktt", "ktw", "lxt", "nde", "ndh"]
+date_from = "20230101"
+date_to = "20250631"
+
+limit = 1000
+max_skip = 25000
+workers = 4
+calls_per_minute = 240 if key else 40
+compress = False
+state_file = "usfda_state.json"
+
+local = threading.local()
+rate_lock = threading.Lock()
+next_call = 0
+state_lock = threading.Lock()
+file_locks = {code: threading.Lock() for code in codes}
+
+def session():
+    if not hasattr(local, "session"):
+        local.session = requests.Session()
+        if key:
+            local.session.headers.update({"api_key": key})
+    return local.session
+
+def wait():
+    global next_call
+    with rate_lock:
+        now = time.monotonic()
+        delay = max(0, next_call - now)
+        next_call = max(now, next_call) + 60 / calls_per_minute
+    time.sleep(delay)
 
-def get_total(code):
-    call = requests.get(url, headers={"api_key":key}, params={"limit": 1, "search":"device.device_report_product_code:" + code + " AND date_received:[20230101 TO 20250631]"})
-    print(call.url)
-    response = call.json()
-    return int(response["meta"]["results"]["total"]) // 1000 + 1 
+def search(code, start, end):
+    return "device.device_report_product_code:" + code + " AND date_received:[" + start + " TO " + end + "]"
 
-def get_data(delay, skip, code):
+def call(params, delay=0):
     while True:
         time.sleep(delay)
+        wait()
         try:
-            response = requests.get(url, headers={"api_key":key}, params={"skip": skip, "limit": 1000, "search":"device.device_report_product_code:" + code + " AND date_received:[20230101 TO 20250631]"})
+            response = session().get(url, params=params)
+            if response.status_code == 404:
+                return {"meta": {"results": {"total": 0}}, "results": []}
+            if response.status_code == 429:
+                delay = float(response.headers.get("Retry-After", 30))
+                continue
             response.raise_for_status()
+            return response.json()
 
-            return response.json()["results"]
-            
-        except requests.exceptions.RequestException as e:
+        except (requests.exceptions.RequestException, ValueError) as e:
             print({e})
             delay = 30
             continue
 
+def get_total(code, start, end):
+    response = call({"limit": 1, "search": search(code, start, end)})
+    return int(response["meta"]["results"]["total"])
+
+def split(code, start, end):
+    total = get_total(code, start, end)
+    print(f"{code} {start}-{end} total: {total}")
+    if total <= max_skip + limit:
+        return [(code, start, end, skip) for skip in range(0, total, limit)]
+
+    first = datetime.datetime.strptime(start, "%Y%m%d").date()
+    last = datetime.datetime.strptime(date_cap(end), "%Y%m%d").date()
+    if first >= last:
+        print(f"{code} {start}-{end}: {total} records on one day, only the first {max_skip + limit} can be downloaded")
+        return [(code, start, end, skip) for skip in range(0, max_skip + limit, limit)]
+
+    middle = first + (last - first) // 2
+    return split(code, start, middle.strftime("%Y%m%d")) + split(code, (middle + datetime.timedelta(days=1)).strftime("%Y%m%d"), end)
+
+def date_cap(end):
+    # Clamp ends like 20250631 to a real date so the range can be halved.
+    year, month = int(end[:4]), int(end[4:6])
+    days = (datetime.date(year + month // 12, month % 12 + 1, 1) - datetime.timedelta(days=1)).day
+    return end[:6] + str(min(int(end[6:]), days)).zfill(2)
+
+def page_key(code, start, end, skip):
+    return f"{code}|{start}|{end}|{skip}"
+
+def load_state():
+    if os.path.exists(state_file):
+        with open(state_file, "r") as f:
+            return set(json.load(f))
+    return set()
+
+def save_state(done):
+    with open(state_file + ".tmp", "w") as f:
+        json.dump(sorted(done), f)
+    os.replace(state_file + ".tmp", state_file)
+
+def output(code):
+    return "usfda_" + code + (".ndjson.gz" if compress else ".ndjson")
+
+def get_data(code, start, end, skip, done):
+    results = call({"skip": skip, "limit": limit, "search": search(code, start, end)}).get("results", [])
+    lines = "".join(json.dumps(record) + "\n" for record in results)
+
+    with file_locks[code]:
+        with (gzip.open(output(code), "at", encoding="utf-8") if compress else open(output(code), "a", encoding="utf-8")) as f:
+            f.write(lines)
+
+    with state_lock:
+        done.add(page_key(code, start, end, skip))
+        save_state(done)
+
+    return len(results)
+
 
 if __name__ == "__main__":
 
-    for code in codes:
+    start_time = time.time()
+    done = load_state()
+    if not done:
+        for code in codes:
+            if os.path.exists(output(code)):
+                os.remove(output(code))
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        pages = []
+        for result in executor.map(lambda code: split(code, date_from, date_to), codes):
+            pages.extend(result)
+
+        remaining = [page for page in pages if page_key(*page) not in done]
+        print(f"{len(pages)} pages, {len(remaining)} remaining")
 
-        skip = 0
-        total = get_total(code)
-        print(f"{code} total: {total}")
+        records = 0
+        futures = [executor.submit(get_data, *page, done) for page in remaining]
+        for i, future in enumerate(concurrent.futures.as_completed(futures)):
+            records += future.result()
+            print(f"Call {i + 1} of {len(remaining)}")
 
-        data = []
-        for i in range(total):
-            print(f"Call {i + 1} of {total}")
-            call = get_data(0, skip, code)
-            data.extend(call)
-            skip += 1000
+    if os.path.exists(state_file):
+        os.remove(state_file)
 
-        with open("usfda_" + code + ".json", "w") as f:
-            json.dump(data, f, indent=4)
+    print(f"{records} records downloaded in {time.strftime('%Hh %Mm %Ss', time.gmtime(time.time() - start_time))}")